@@ -108,10 +108,11 @@ class AliIot:
 
         return str(_id)
 
-    def __put_post_res(self, msg_id, res):
-        self.__post_res[msg_id] = res
+    def __put_post_res(self, msg_id, code):
+        self.__post_res[msg_id] = code
 
-    def __get_post_res(self, msg_id):
+    def __get_post_code(self, msg_id):
+        """Wait the reply code of a published message, None if no reply in 30 seconds."""
         with self.__get_post_lock:
             count = 0
             while count < int(30 * 1000 / 50):
@@ -119,15 +120,17 @@ class AliIot:
                     break
                 utime.sleep_ms(50)
                 count += 1
-            if count >= 600 and self.__post_res.get(msg_id) is None:
-                self.__post_res[msg_id] = False
-            res = self.__post_res.pop(msg_id)
-            return res
+            return self.__post_res.pop(msg_id, None)
+
+    def __get_post_res(self, msg_id):
+        return self.__get_post_code(msg_id) == 200
 
     def __init_topics(self):
         # module object topic
         self.ica_topic_property_post = "/sys/%s/%s/thing/event/property/post" % (self.__product_key, self.__device_name)
         self.ica_topic_property_post_reply = "/sys/%s/%s/thing/event/property/post_reply" % (self.__product_key, self.__device_name)
+        self.ica_topic_property_batch_post = "/sys/%s/%s/thing/event/property/batch/post" % (self.__product_key, self.__device_name)
+        self.ica_topic_property_batch_post_reply = "/sys/%s/%s/thing/event/property/batch/post_reply" % (self.__product_key, self.__device_name)
         self.ica_topic_property_set = "/sys/%s/%s/thing/service/property/set" % (self.__product_key, self.__device_name)
         self.ica_topic_property_set_reply = "/sys/%s/%s/thing/service/property/set_reply" % (self.__product_key, self.__device_name)
         self.ica_topic_event_post = "/sys/%s/%s/thing/event/{}/post" % (self.__product_key, self.__device_name)
@@ -153,10 +156,10 @@ class AliIot:
         log.debug("topic: %s, data: %s" % (topic, str(data)))
 
         if topic.endswith("/post_reply"):
-            self.__put_post_res(data["id"], True if int(data["code"]) == 200 else False)
+            self.__put_post_res(data["id"], int(data["code"]))
             return
         elif topic.endswith("/thing/ota/firmware/get_reply"):
-            self.__put_post_res(data["id"], True if int(data["code"]) == 200 else False)
+            self.__put_post_res(data["id"], int(data["code"]))
 
         if self.__callback and callable(self.__callback):
             self.__callback((topic, data))
@@ -171,6 +174,8 @@ class AliIot:
         res = 0
         if not self.__subscribe_topic(self.ica_topic_property_post_reply):
             res = 1
+        if not self.__subscribe_topic(self.ica_topic_property_batch_post_reply):
+            res = 1
         if not self.__subscribe_topic(self.ica_topic_property_set):
             res = 2
         if not self.__subscribe_topic(self.ota_topic_device_upgrade):
@@ -292,6 +297,57 @@ class AliIot:
         pub_res = self.__server.publish(self.ica_topic_event_post.format(event), ujson.dumps(properties), qos=self.__qos) if self.__server else -1
         return self.__get_post_res(_id) if pub_res is True else False
 
+    def batch_report(self, samples, max_size=0x8000):
+        """Report properties and events of many samples in one message with one ack.
+
+        Samples are packed from the head until the message size is over `max_size`,
+        the first sample is always packed. Values of a key are grouped under the key,
+        so the key is counted once per message and each sample adds its values only.
+
+        Args:
+            samples (list): [(time, properties, events), ...]
+                time (int): millisecond timestamp, None for now.
+                properties (dict): {key: value}
+                events (list): event names.
+            max_size (int): max message size, unit: byte.
+
+        Returns:
+            int: count of reported samples from the head,
+                 0 - not sent or no reply, -1 - rejected by server reply code.
+        """
+        _id = self.__id
+        params = {"properties": {}, "events": {}}
+        size = 200
+        count = 0
+        for _time, properties, events in samples:
+            _time = _time if _time else int(self.__timestamp)
+            # {"value": xxx, "time": xxx}, and "key": [], for a new key.
+            _size = sum([len(ujson.dumps(val)) + len(str(_time)) + 23 + (0 if key in params["properties"] else len(key) + 6)
+                         for key, val in properties.items()])
+            _size += sum([len(str(_time)) + 25 + (0 if event in params["events"] else len(event) + 6) for event in events])
+            if count and size + _size > max_size:
+                break
+            size += _size
+            for key, val in properties.items():
+                params["properties"].setdefault(key, []).append({"value": val, "time": _time})
+            for event in events:
+                params["events"].setdefault(event, []).append({"value": {}, "time": _time})
+            count += 1
+        data = {
+            "id": _id,
+            "version": "1.0",
+            "sys": {
+                "ack": 1
+            },
+            "params": params,
+            "method": "thing.event.property.batch.post",
+        }
+        pub_res = self.__server.publish(self.ica_topic_property_batch_post, ujson.dumps(data), qos=self.__qos) if self.__server else -1
+        if pub_res is not True:
+            return 0
+        code = self.__get_post_code(_id)
+        return count if code == 200 else (0 if code is None else -1)
+
     def service_response(self, service, code, data, msg_id, message):
         pub_data = {
             "code": code,
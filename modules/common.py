@@ -35,11 +35,19 @@
 @copyright :Copyright (c) 2022
 """
 
+import uos
+import ql_fs
 import utime
 import _thread
 import usys as sys
+from queue import Queue
 from machine import Pin
 
+try:
+    from ubinascii import crc32 as _crc32
+except ImportError:
+    _crc32 = None
+
 
 def option_lock(thread_lock):
     """Function thread lock decorator"""
@@ -51,6 +59,86 @@ def option_lock(thread_lock):
     return function_lock
 
 
+def atomic_touch(file, data):
+    """Write JSON data to file through a temp file and rename.
+
+    The old file is kept complete if power is lost while writing.
+
+    Args:
+        file (str): filename include full path.
+        data (dict): JSON data.
+
+    Returns:
+        int: 0 - success, -1 - failed, same as `ql_fs.touch`.
+    """
+    tmp_file = file + ".tmp"
+    try:
+        if ql_fs.touch(tmp_file, data) != 0:
+            return -1
+        try:
+            uos.rename(tmp_file, file)
+        except OSError:
+            uos.remove(file)
+            uos.rename(tmp_file, file)
+        return 0
+    except Exception as e:
+        sys.print_exception(e)
+        return -1
+
+
+def atomic_read_json(file):
+    """Read JSON file written by `atomic_touch`.
+
+    If the file is missing or broken, the temp file left by an interrupted rename is used.
+
+    Args:
+        file (str): filename include full path.
+
+    Returns:
+        dict: JSON data, None if no valid file.
+    """
+    for i in (file, file + ".tmp"):
+        if ql_fs.path_exists(i):
+            try:
+                data = ql_fs.read_json(i)
+                if data is not None:
+                    return data
+            except Exception as e:
+                sys.print_exception(e)
+    return None
+
+
+_CRC32_TABLE = None
+
+
+def crc32(data, crc=0):
+    """Calculate CRC-32 (IEEE 802.3) of data.
+
+    Use ubinascii.crc32 if the firmware has it, else a table driven implementation.
+
+    Args:
+        data (bytes): data to check.
+        crc (int): CRC of previous data, for calculate in parts.
+
+    Returns:
+        int: CRC-32 value.
+    """
+    global _CRC32_TABLE
+    if _crc32 is not None:
+        return _crc32(data, crc) & 0xFFFFFFFF
+    if _CRC32_TABLE is None:
+        _CRC32_TABLE = []
+        for i in range(256):
+            c = i
+            for _ in range(8):
+                c = (c >> 1) ^ 0xEDB88320 if c & 1 else c >> 1
+            _CRC32_TABLE.append(c)
+    crc = crc ^ 0xFFFFFFFF
+    for b in data:
+        crc = _CRC32_TABLE[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
 class Singleton(object):
     """Singleton base class"""
     _instance_lock = _thread.allocate_lock()
@@ -290,3 +378,127 @@ class Event(object):
 
     def is_set(self):
         return self.flag
+
+
+class Future(object):
+    """Result of a task submitted to `ThreadPool`."""
+
+    PENDING = 0
+    RUNNING = 1
+    FINISHED = 2
+    CANCELLED = 3
+
+    def __init__(self, func, args):
+        self.__func = func
+        self.__args = args
+        self.__state = self.PENDING
+        self.__result = None
+        self.__exception = None
+        self.__lock = _thread.allocate_lock()
+
+    def run(self):
+        """Run the task in a pool worker, skipped if the future is cancelled."""
+        with self.__lock:
+            if self.__state != self.PENDING:
+                return
+            self.__state = self.RUNNING
+        result = None
+        exception = None
+        try:
+            result = self.__func(*self.__args)
+        except Exception as e:
+            sys.print_exception(e)
+            exception = e
+        with self.__lock:
+            if self.__state == self.RUNNING:
+                self.__result = result
+                self.__exception = exception
+                self.__state = self.FINISHED
+
+    def cancel(self):
+        """Cancel the task if it is not started.
+
+        A running task can not be stopped, it keeps its worker until it returns.
+
+        Returns:
+            bool: True - cancelled, False - task is running or done.
+        """
+        with self.__lock:
+            if self.__state == self.PENDING:
+                self.__state = self.CANCELLED
+            return self.__state == self.CANCELLED
+
+    def cancelled(self):
+        return self.__state == self.CANCELLED
+
+    def done(self):
+        return self.__state in (self.FINISHED, self.CANCELLED)
+
+    @property
+    def exception(self):
+        return self.__exception
+
+    def result(self, timeout=None, default=None):
+        """Wait the task result.
+
+        Args:
+            timeout (int/None): max wait seconds, None for wait forever. (default: `None`)
+            default: returned when task timeout, cancelled or raised. (default: `None`)
+
+        Returns:
+            task return value or `default`.
+        """
+        count = 0
+        while not self.done():
+            if timeout is not None and count >= int(timeout * 1000 / 50):
+                return default
+            utime.sleep_ms(50)
+            count += 1
+        return self.__result if self.__state == self.FINISHED and self.__exception is None else default
+
+
+class ThreadPool(object):
+    """Persistent worker threads for running tasks.
+
+    Workers are started on the first `submit` and wait tasks on a queue,
+    so no thread is created or killed per task.
+    """
+
+    def __init__(self, workers=2, stack_size=0x2000):
+        """
+        Parameter:
+            workers: count of worker threads
+            stack_size: stack size of each worker thread
+        """
+        self.__workers = workers
+        self.__stack_size = stack_size
+        self.__tasks = Queue()
+        self.__tids = []
+        self.__lock = _thread.allocate_lock()
+
+    def __worker(self):
+        while True:
+            future = self.__tasks.get()
+            future.run()
+
+    def __start(self):
+        with self.__lock:
+            while len(self.__tids) < self.__workers:
+                _thread.stack_size(self.__stack_size)
+                self.__tids.append(_thread.start_new_thread(self.__worker, ()))
+
+    def submit(self, func, *args):
+        """Submit a task.
+
+        Args:
+            func (function): task function.
+            args: task function args.
+
+        Returns:
+            Future: task future.
+        """
+        if len(self.__tids) < self.__workers:
+            self.__start()
+        future = Future(func, args)
+        self.__tasks.put(future)
+        return future
@@ -38,65 +38,970 @@
 import uos
 import ql_fs
 import ujson
+import ustruct
 import _thread
+import usys as sys
+
+from usr.modules.logging import getLogger
+from usr.modules.common import crc32, atomic_touch, atomic_read_json
+
+log = getLogger(__name__)
 
 
 class History:
-    """This class is for manage history file."""
+    """This class is for manage history file.
+
+    History file is an append only log, each write appends one record and nothing stored is rewritten.
+    The log of generation `gen` is segment file `history_file + "." + str(gen % segments)`,
+    a new generation is started when all records are consumed or the log is compacted,
+    so erase cycles are spread over the segments. Generation and estimated write count of each segment
+    are kept in `history_file + ".meta"`, updated when the generation changes.
+        file header: b"HLOG", generation (u32)
+        record: magic (u8), payload length (u16), data count (u16), payload CRC-32 (u32), payload (codec encoded list)
+    Consumed position is kept in a cursor file `history_file + ".cur"` written by `atomic_touch`:
+        {"gen": file generation, "offset": offset of the first unread record, "skip": data count to skip in this record}
+    Files are removed when all records are consumed.
+    After power lost, records are recovered up to the first broken one and the broken tail is overwritten by next write.
+
+    When unread records are over `max_bytes`, the log is compacted to `max_bytes * compact_ratio`:
+    data of the lowest priority class are downsampled (keep every 2nd, 4th, 8th counted back from the newest,
+    events are not downsampled), then dropped from the oldest, before the next class is touched.
+    The compacted log is written to the segment of the next generation before the meta file is updated,
+    a cursor of another generation means the whole file is unread.
 
-    def __init__(self, history_file="/usr/tracker_data.hist", max_hist_num=100):
+    With `timestamp`, a sparse time index `history_file + ".idx"` is appended every `index_step` bytes of log:
+        index header: b"HIDX", generation (u32)
+        index entry: timestamp of the first data of a record (u32), record offset (u32)
+    `query` finds the start offset by the index and reads the time range in pages, time is expected to increase.
+    With `retain_bytes`, consumed records are kept for `query` until the log is over it.
+    """
+
+    PRIO_STATIC = 0
+    PRIO_FIX = 1
+    PRIO_EVENT = 2
+
+    __FILE_MAGIC = b"HLOG"
+    __FILE_HEADER_FMT = ">4sI"
+    __FILE_HEADER_SIZE = ustruct.calcsize(__FILE_HEADER_FMT)
+    __MAGIC = 0xA5
+    __HEADER_FMT = ">BHHI"
+    __HEADER_SIZE = ustruct.calcsize(__HEADER_FMT)
+    __COMPACT_CHUNK = 32
+    __INDEX_MAGIC = b"HIDX"
+    __INDEX_FMT = ">II"
+    __INDEX_SIZE = ustruct.calcsize(__INDEX_FMT)
+
+    def __init__(self, history_file="/usr/tracker_data.hist", max_hist_num=100, codec=None,
+                 max_bytes=None, priority=None, compact_ratio=0.75, timestamp=None, index_step=1024, retain_bytes=0,
+                 segments=4, meta_step=16):
         """
         Parameter:
             history_file: filename include full path
-            max_hist_num: history data list max size
+            max_hist_num: history data list max size, None for no limit
+            codec: record codec object with `encode(list)`, `decode(bytes)` and optional `clean()`,
+                   default is `JSONCodec`, `TrackCodec` for compact track points
+            max_bytes: unread records max size, unit: byte, None for no limit
+            priority: function of history data returns `PRIO_STATIC`, `PRIO_FIX` or `PRIO_EVENT`,
+                      default all data are `PRIO_FIX`
+            compact_ratio: size ratio of `max_bytes` after compacted
+            timestamp: function of history data returns its time in seconds or None, enable time index and `query`
+            index_step: min log bytes between two index entries
+            retain_bytes: keep consumed records for `query` while the log is not over it, unit: byte
+            segments: segment file count for rotation, at least 2
+            meta_step: save segment write counts every `meta_step` writes, and by `flush`
         """
-        self.__history = history_file
+        self.__base = history_file
+        self.__meta_file = history_file + ".meta"
+        self.__segments = max(2, segments)
+        self.__writes = [0] * self.__segments
+        self.__meta_step = meta_step
+        self.__unsaved_writes = 0
+        self.__history = self.__segment(0)
+        self.__cursor_file = history_file + ".cur"
+        self.__legacy_file = history_file + ".old"
         self.__max_hist_num = max_hist_num
+        self.__codec = codec if codec else JSONCodec
+        self.__max_bytes = max_bytes
+        self.__priority = priority
+        self.__compact_ratio = compact_ratio
+        self.__timestamp = timestamp
+        self.__index_file = history_file + ".idx"
+        self.__index_step = index_step
+        self.__index = []
+        self.__retain_bytes = retain_bytes
+        self.__gen = 0
         self.__history_lock = _thread.allocate_lock()
+        # Unread records [(offset, count), ...], read cursor skip and append offset.
+        self.__records = []
+        self.__skip = 0
+        self.__end = 0
+        # Data count dropped by trim, to correct a commit of a page read before trim.
+        self.__dropped = 0
+        self.__peek_dropped = 0
+        # A page read before compaction can not be committed.
+        self.__page_valid = True
+        self.__load()
 
-    def __read(self):
-        """Read history file info.
+    def __pending(self):
+        return sum([i[1] for i in self.__records]) - self.__skip
 
-        Returns:
-            dict: history data list.
-                data format:
-                {
-                    "data": [xxx, xxx, xxx]
-                }
+    def __segment(self, gen):
+        return self.__base + "." + str(gen % self.__segments)
+
+    def __rotate(self, gen):
+        """Switch to the segment of generation and save meta file."""
+        self.__gen = gen
+        self.__history = self.__segment(gen)
+        self.__save_meta()
+
+    def __save_meta(self):
+        res = atomic_touch(self.__meta_file, {"gen": self.__gen, "writes": self.__writes})
+        if res == 0:
+            self.__unsaved_writes = 0
+        return res == 0
+
+    def __load_meta(self):
+        """Load generation and write counts, move a log file without segment into its segment."""
+        meta = atomic_read_json(self.__meta_file)
+        if isinstance(meta, dict):
+            writes = meta.get("writes", [])
+            self.__writes = (writes + [0] * self.__segments)[:self.__segments]
+            self.__gen = meta.get("gen", 0)
+            self.__history = self.__segment(self.__gen)
+        if ql_fs.path_exists(self.__base):
+            with open(self.__base, "rb") as f:
+                header = f.read(self.__FILE_HEADER_SIZE)
+            if header[:1] == b"{":
+                uos.rename(self.__base, self.__legacy_file)
+            else:
+                gen = ustruct.unpack(self.__FILE_HEADER_FMT, header)[1] if header[:4] == self.__FILE_MAGIC else 0
+                self.__rotate(gen)
+                uos.rename(self.__base, self.__history)
+
+    def __load(self):
+        """Load read cursor and scan unread records, migrate legacy JSON history file."""
+        self.__records = []
+        self.__skip = 0
+        self.__end = 0
+        try:
+            self.__load_meta()
+            if ql_fs.path_exists(self.__legacy_file):
+                self.__migrate()
+                return
+            if not ql_fs.path_exists(self.__history):
+                return
+            with open(self.__history, "rb") as f:
+                header = f.read(self.__FILE_HEADER_SIZE)
+            if len(header) == self.__FILE_HEADER_SIZE and header[:4] == self.__FILE_MAGIC:
+                self.__gen = ustruct.unpack(self.__FILE_HEADER_FMT, header)[1]
+                offset = self.__FILE_HEADER_SIZE
+            else:
+                offset = 0
+            cursor = atomic_read_json(self.__cursor_file)
+            if isinstance(cursor, dict) and cursor.get("gen", 0) == self.__gen:
+                offset = cursor.get("offset", offset)
+                self.__skip = cursor.get("skip", 0)
+            with open(self.__history, "rb") as f:
+                while True:
+                    f.seek(offset)
+                    header = f.read(self.__HEADER_SIZE)
+                    if len(header) < self.__HEADER_SIZE:
+                        break
+                    magic, length, count, crc = ustruct.unpack(self.__HEADER_FMT, header)
+                    if magic != self.__MAGIC:
+                        break
+                    payload = f.read(length)
+                    if len(payload) < length or crc32(payload) != crc:
+                        log.warn("History record at %s is broken, stop at it." % offset)
+                        break
+                    self.__records.append((offset, count))
+                    offset += self.__HEADER_SIZE + length
+            self.__end = offset
+            if not self.__records and self.__end > self.__retain_bytes:
+                self.__reset()
+            else:
+                self.__load_index()
+        except Exception as e:
+            sys.print_exception(e)
+
+    def __load_index(self):
+        """Load time index entries, an index of another generation is removed."""
+        self.__index = []
+        if not self.__timestamp or not ql_fs.path_exists(self.__index_file):
+            return
+        with open(self.__index_file, "rb") as f:
+            header = f.read(self.__FILE_HEADER_SIZE)
+            if len(header) == self.__FILE_HEADER_SIZE and \
+                    ustruct.unpack(self.__FILE_HEADER_FMT, header) == (self.__INDEX_MAGIC, self.__gen):
+                while True:
+                    entry = f.read(self.__INDEX_SIZE)
+                    if len(entry) < self.__INDEX_SIZE:
+                        break
+                    self.__index.append(ustruct.unpack(self.__INDEX_FMT, entry))
+                return
+        log.warn("History index generation changed, remove it.")
+        uos.remove(self.__index_file)
+
+    def __index_entry(self, data, offset):
+        """Index entry of a record, None if it is too close to the last entry or has no time."""
+        if not self.__timestamp or (self.__index and offset - self.__index[-1][1] < self.__index_step):
+            return None
+        for item in data:
+            ts = self.__timestamp(item) if item is not None else None
+            if ts is not None:
+                return (ts, offset)
+        return None
+
+    def __write_index(self, entries, append=True):
+        if not entries:
+            return
+        with open(self.__index_file, "ab" if append and ql_fs.path_exists(self.__index_file) else "wb") as f:
+            if f.tell() == 0:
+                f.write(ustruct.pack(self.__FILE_HEADER_FMT, self.__INDEX_MAGIC, self.__gen))
+            for entry in entries:
+                f.write(ustruct.pack(self.__INDEX_FMT, *entry))
+
+    def __migrate(self):
+        """Move legacy JSON history data into the append only log.
+
+        Legacy file is removed after migrated, so an interrupted migration is run again on next load.
         """
-        res = {"data": []}
+        data = []
+        try:
+            hist_data = ql_fs.read_json(self.__legacy_file)
+            if isinstance(hist_data, dict):
+                data = hist_data.get("data", [])
+        except Exception as e:
+            log.error("History legacy file read failed, drop it.")
+            sys.print_exception(e)
+        self.__reset()
+        if self.__max_hist_num:
+            data = data[self.__max_hist_num * -1:]
+        if not data or self.__append(data):
+            uos.remove(self.__legacy_file)
+
+    def __reset(self):
+        """Remove history file, cursor file and codec data, next write starts the next segment."""
+        self.__records = []
+        self.__skip = 0
+        self.__end = 0
+        self.__index = []
+        for i in (self.__cursor_file, self.__cursor_file + ".tmp", self.__index_file):
+            if ql_fs.path_exists(i):
+                uos.remove(i)
         if ql_fs.path_exists(self.__history):
-            with open(self.__history, "r") as f:
-                try:
-                    hist_data = ujson.load(f)
-                    if isinstance(hist_data, dict):
-                        res["data"] = hist_data.get("data", [])
-                except Exception:
-                    pass
+            uos.remove(self.__history)
+            self.__rotate(self.__gen + 1)
+        if hasattr(self.__codec, "clean"):
+            self.__codec.clean()
+
+    def __save_cursor(self):
+        offset = self.__records[0][0] if self.__records else self.__end
+        atomic_touch(self.__cursor_file, {"gen": self.__gen, "offset": offset, "skip": self.__skip})
+
+    def __append(self, data):
+        """Append one record at the end of history file.
+
+        Args:
+            data (list): history data list.
+
+        Returns:
+            bool: True - success, False - faliled.
+        """
+        payload = self.__codec.encode(data)
+        header = ustruct.pack(self.__HEADER_FMT, self.__MAGIC, len(payload), len(data), crc32(payload))
+        try:
+            if not ql_fs.path_exists(self.__history):
+                with open(self.__history, "wb") as f:
+                    f.write(ustruct.pack(self.__FILE_HEADER_FMT, self.__FILE_MAGIC, self.__gen))
+                self.__end = self.__FILE_HEADER_SIZE
+                self.__save_cursor()
+            # Write at the end of the last valid record, overwrite a broken tail if there is.
+            with open(self.__history, "r+b") as f:
+                f.seek(self.__end)
+                f.write(header)
+                f.write(payload)
+            self.__writes[self.__gen % self.__segments] += 1
+            self.__unsaved_writes += 1
+            if self.__unsaved_writes >= self.__meta_step:
+                self.__save_meta()
+            entry = self.__index_entry(data, self.__end)
+            if entry:
+                self.__write_index([entry])
+                self.__index.append(entry)
+            self.__records.append((self.__end, len(data)))
+            self.__end += self.__HEADER_SIZE + len(payload)
+            return True
+        except Exception as e:
+            sys.print_exception(e)
+            return False
+
+    def __trim(self):
+        """Drop the oldest data over max_hist_num by moving the read cursor."""
+        if not self.__max_hist_num:
+            return
+        over = self.__pending() - self.__max_hist_num
+        if over <= 0:
+            return
+        while over > 0 and self.__records:
+            left = self.__records[0][1] - self.__skip
+            if left <= over:
+                self.__records.pop(0)
+                self.__skip = 0
+                self.__dropped += left
+                over -= left
+            else:
+                self.__skip += over
+                self.__dropped += over
+                over = 0
+        self.__save_cursor()
+
+    def __read_items(self, f, num=None):
+        """Read unread data from read cursor, a broken record gives None items.
+
+        Args:
+            f: opened history file.
+            num (int): max data count, None for all.
+
+        Returns:
+            list: history data list.
+        """
+        res = []
+        skip = self.__skip
+        for offset, count in self.__records:
+            f.seek(offset)
+            magic, length, count, crc = ustruct.unpack(self.__HEADER_FMT, f.read(self.__HEADER_SIZE))
+            payload = f.read(length)
+            if crc32(payload) != crc:
+                # Keep position of data count, a broken record gives None items to skip.
+                log.warn("History record at %s crc check failed." % offset)
+                data = [None] * count
+            else:
+                data = self.__codec.decode(payload)
+            res.extend(data[skip:] if num is None else data[skip:skip + num - len(res)])
+            skip = 0
+            if num is not None and len(res) >= num:
+                break
         return res
 
-    def __write(self, data):
-        """Write data to history file
+    def __evict(self, sizes, prios, budget):
+        """Choose data to keep in budget, lowest priority class first, downsample before drop.
 
         Args:
+            sizes (list): encoded size of each data.
+            prios (list): priority class of each data.
+            budget (int): max total size.
+
+        Returns:
+            list: bool of each data, True - keep.
+        """
+        keep = [True] * len(sizes)
+        total = sum(sizes)
+        for prio in sorted(set(prios)):
+            if total <= budget:
+                break
+            index = [i for i, p in enumerate(prios) if p == prio]
+            if prio < self.PRIO_EVENT:
+                for stride in (2, 4, 8):
+                    if total <= budget:
+                        break
+                    for n, i in enumerate(reversed(index)):
+                        if keep[i] and n % stride:
+                            keep[i] = False
+                            total -= sizes[i]
+            for i in index:
+                if total <= budget:
+                    break
+                if keep[i]:
+                    keep[i] = False
+                    total -= sizes[i]
+        return keep
+
+    def __compact(self):
+        """Evict unread data over budget and rewrite the log with next generation."""
+        with open(self.__history, "rb") as f:
+            data = [i for i in self.__read_items(f) if i is not None]
+        sizes = [len(self.__codec.encode([i])) + self.__HEADER_SIZE for i in data]
+        prios = [self.__priority(i) if self.__priority else self.PRIO_FIX for i in data]
+        keep = self.__evict(sizes, prios, int(self.__max_bytes * self.__compact_ratio))
+        data = [i for i, k in zip(data, keep) if k]
+        log.info("History compacted, keep %s of %s data." % (len(data), len(keep)))
+        self.__page_valid = False
+        if not data:
+            self.__reset()
+            return
+        gen = self.__gen + 1
+        records = []
+        self.__index = []
+        offset = self.__FILE_HEADER_SIZE
+        old_file = self.__history
+        with open(self.__segment(gen), "wb") as f:
+            f.write(ustruct.pack(self.__FILE_HEADER_FMT, self.__FILE_MAGIC, gen))
+            for i in range(0, len(data), self.__COMPACT_CHUNK):
+                chunk = data[i:i + self.__COMPACT_CHUNK]
+                payload = self.__codec.encode(chunk)
+                f.write(ustruct.pack(self.__HEADER_FMT, self.__MAGIC, len(payload), len(chunk), crc32(payload)))
+                f.write(payload)
+                entry = self.__index_entry(chunk, offset)
+                if entry:
+                    self.__index.append(entry)
+                records.append((offset, len(chunk)))
+                offset += self.__HEADER_SIZE + len(payload)
+                self.__writes[gen % self.__segments] += 1
+        self.__rotate(gen)
+        self.__records = records
+        self.__skip = 0
+        self.__end = offset
+        self.__save_cursor()
+        self.__write_index(self.__index, append=False)
+        uos.remove(old_file)
+
+    def __move(self, count):
+        """Move read cursor forward by data count, remove files if all consumed."""
+        while count > 0 and self.__records:
+            left = self.__records[0][1] - self.__skip
+            if left <= count:
+                self.__records.pop(0)
+                self.__skip = 0
+                count -= left
+            else:
+                self.__skip += count
+                count = 0
+        if self.__records or self.__end <= self.__retain_bytes:
+            self.__save_cursor()
+        else:
+            self.__reset()
+
+    def read(self):
+        """Read history info
+
+        Return:
             data (dict): history data.
                 data format:
                 {
                     "data": [xxx, xxx, xxx]
                 }
+        """
+        with self.__history_lock:
+            res = {"data": []}
+            if not self.__records:
+                return res
+            try:
+                with open(self.__history, "rb") as f:
+                    res["data"] = [i for i in self.__read_items(f) if i is not None]
+                self.__reset()
+            except Exception as e:
+                sys.print_exception(e)
+            return res
+
+    def peek(self, num=10):
+        """Read history data from read cursor without consuming it.
+
+        Only records of this page are loaded, call `commit` after the page is reported.
+
+        Args:
+            num (int): max data count of this page.
+
+        Returns:
+            list: history data list, empty if no history.
+        """
+        with self.__history_lock:
+            res = []
+            self.__peek_dropped = self.__dropped
+            self.__page_valid = True
+            if not self.__records:
+                return res
+            try:
+                with open(self.__history, "rb") as f:
+                    res = self.__read_items(f, num)
+            except Exception as e:
+                sys.print_exception(e)
+            return res
+
+    def commit(self, count):
+        """Consume history data reported from the last `peek`.
+
+        Args:
+            count (int): data count reported from the head of the last page.
 
         Returns:
             bool: True - success, False - faliled.
         """
-        try:
-            with open(self.__history, "w") as f:
-                ujson.dump(data, f)
+        with self.__history_lock:
+            if not self.__page_valid:
+                log.warn("History compacted after peek, the page will be read again.")
                 return True
-        except:
-            return False
+            # Data dropped by trim after peek were in the head of the page.
+            count -= self.__dropped - self.__peek_dropped
+            self.__peek_dropped = self.__dropped
+            if count <= 0:
+                return True
+            try:
+                self.__move(count)
+                return True
+            except Exception as e:
+                sys.print_exception(e)
+                return False
+
+    def flush(self):
+        """Save segment write counts not saved yet, call it before sleep or power down.
+
+        Returns:
+            bool: True - success, False - faliled.
+        """
+        with self.__history_lock:
+            return self.__save_meta() if self.__unsaved_writes else True
+
+    def diagnostics(self):
+        """Get history storage diagnostics.
+
+        Returns:
+            dict: {
+                "gen": current generation,
+                "unread": unread data count,
+                "segments": [{"file": filename, "writes": estimated write count, "size": file size}, ...]
+            }
+        """
+        with self.__history_lock:
+            segments = []
+            for i in range(self.__segments):
+                file = self.__base + "." + str(i)
+                size = ql_fs.path_getsize(file) if ql_fs.path_exists(file) else 0
+                segments.append({"file": file, "writes": self.__writes[i], "size": size})
+            return {"gen": self.__gen, "unread": self.__pending(), "segments": segments}
+
+    def query(self, start, end, num=10, token=None):
+        """Read history data in a time range without consuming it.
+
+        Args:
+            start (int): start time in seconds, include.
+            end (int): end time in seconds, include.
+            num (int): max data count of this page.
+            token (str): `next` of the previous page, None for the first page.
+
+        Returns:
+            dict: {"data": [xxx, xxx], "next": token of next page, None if no more}
+        """
+        with self.__history_lock:
+            res = {"data": [], "next": None}
+            if not self.__timestamp or not ql_fs.path_exists(self.__history):
+                return res
+            offset, skip = None, 0
+            if token:
+                gen, _offset, _skip = [int(i) for i in token.split(".")]
+                if gen == self.__gen:
+                    offset, skip = _offset, _skip
+            if offset is None:
+                with open(self.__history, "rb") as f:
+                    offset = self.__FILE_HEADER_SIZE if f.read(4) == self.__FILE_MAGIC else 0
+                # Start from the last indexed record earlier than start time.
+                low, high = 0, len(self.__index) - 1
+                while low <= high:
+                    mid = (low + high) // 2
+                    if self.__index[mid][0] < start:
+                        offset = self.__index[mid][1]
+                        low = mid + 1
+                    else:
+                        high = mid - 1
+            try:
+                with open(self.__history, "rb") as f:
+                    while offset < self.__end:
+                        f.seek(offset)
+                        magic, length, count, crc = ustruct.unpack(self.__HEADER_FMT, f.read(self.__HEADER_SIZE))
+                        payload = f.read(length)
+                        data = self.__codec.decode(payload) if crc32(payload) == crc else []
+                        for i in range(skip, len(data)):
+                            ts = self.__timestamp(data[i])
+                            if ts is None or ts < start:
+                                continue
+                            if ts > end:
+                                return res
+                            if len(res["data"]) >= num:
+                                res["next"] = "%s.%s.%s" % (self.__gen, offset, i)
+                                return res
+                            res["data"].append(data[i])
+                        offset += self.__HEADER_SIZE + length
+                        skip = 0
+            except Exception as e:
+                sys.print_exception(e)
+            return res
+
+    def write(self, data):
+        """Data format for write history
+
+        Args:
+            data (list): history data list.
+
+        Returns:
+            bool: True - success, False - faliled.
+        """
+        if not data:
+            return True
+        with self.__history_lock:
+            res = self.__append(data)
+            if res:
+                self.__trim()
+                if self.__max_bytes and self.__records and self.__end - self.__records[0][0] > self.__max_bytes:
+                    try:
+                        self.__compact()
+                    except Exception as e:
+                        sys.print_exception(e)
+            return res
+
+    def clean(self):
+        """Remove history file.
+
+        Returns:
+            bool: True - success, False - faliled.
+        """
+        with self.__history_lock:
+            try:
+                self.__reset()
+                return True
+            except:
+                return False
+
+
+class JSONCodec:
+    """History record codec for any JSON data."""
+
+    @staticmethod
+    def encode(item):
+        return ujson.dumps(item).encode()
+
+    @staticmethod
+    def decode(data):
+        return ujson.loads(data)
+
+
+class TrackCodec:
+    """History record codec for a list of track points, used by `History`.
+
+    Track fields are saved as zigzag varint of scaled delta to the previous point,
+    other fields are saved as JSON diff to a static template kept once in a template file.
+        segment: version (u8), point count (varint), points
+        point: template id (varint), track field mask (varint), track field deltas (zigzag varint),
+               diff length (varint), diff JSON [changed values, removed key paths]
+    Template id 0 means no template and the diff is the whole static part.
+    Segments of version 1 save a removed key as null in a diff dict, they are still decoded.
+    """
+
+    VERSION = 2
+
+    def __init__(self, fields=(), template_file="/usr/tracker_data.tpl", max_templates=16, max_diff_ratio=0.5):
+        """
+        Parameter:
+            fields: track field specs [(path, scale, kind), ...]
+                path: key tuple of the field, e.g. ("properties", "GeoLocation", "Longitude").
+                kind: "f" - float saved as round(value * scale), "i" - int saved as value // scale.
+            template_file: filename include full path
+            max_templates: max template count, points are saved without template when full
+            max_diff_ratio: a new template is added when diff size is over this ratio of static part size
+        """
+        self.__fields = fields
+        self.__template_file = template_file
+        self.__max_templates = max_templates
+        self.__max_diff_ratio = max_diff_ratio
+        self.__templates = {}
+        self.__last_id = 0
+        self.__load()
+
+    def __load(self):
+        data = atomic_read_json(self.__template_file)
+        if isinstance(data, dict):
+            self.__templates = {int(k): v for k, v in data.get("templates", {}).items()}
+            self.__last_id = data.get("last_id", 0)
+
+    def __save(self):
+        templates = {str(k): v for k, v in self.__templates.items()}
+        return atomic_touch(self.__template_file, {"last_id": self.__last_id, "templates": templates}) == 0
+
+    @staticmethod
+    def __zigzag(val):
+        return val * 2 if val >= 0 else val * -2 - 1
+
+    @staticmethod
+    def __unzigzag(val):
+        return val // 2 if not val & 1 else (val + 1) // -2
+
+    @staticmethod
+    def __put_varint(buf, val):
+        while val > 0x7F:
+            buf.append((val & 0x7F) | 0x80)
+            val >>= 7
+        buf.append(val)
+
+    @staticmethod
+    def __get_varint(data, pos):
+        val = 0
+        shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            val |= (b & 0x7F) << shift
+            if not b & 0x80:
+                return val, pos
+            shift += 7
+
+    def __diff(self, base, item, removed, path=()):
+        """Get changed values of item to base, key paths removed from base are appended to removed."""
+        diff = {}
+        for k, v in item.items():
+            if k not in base:
+                diff[k] = v
+            elif isinstance(v, dict) and isinstance(base[k], dict):
+                _diff = self.__diff(base[k], v, removed, path + (k,))
+                if _diff:
+                    diff[k] = _diff
+            elif base[k] != v:
+                diff[k] = v
+        for k in base:
+            if k not in item:
+                removed.append(list(path) + [k])
+        return diff
+
+    def __legacy_removed(self, diff, removed, path=()):
+        """Pop null values of a version 1 diff into removed key paths."""
+        for k in list(diff.keys()):
+            if diff[k] is None:
+                diff.pop(k)
+                removed.append(list(path) + [k])
+            elif isinstance(diff[k], dict):
+                self.__legacy_removed(diff[k], removed, path + (k,))
+
+    def __patch(self, base, diff, removed=()):
+        for k, v in diff.items():
+            if isinstance(v, dict) and isinstance(base.get(k), dict):
+                self.__patch(base[k], v)
+            else:
+                base[k] = v
+        for path in removed:
+            node = base
+            for key in path[:-1]:
+                node = node.get(key) if isinstance(node, dict) else None
+            if isinstance(node, dict):
+                node.pop(path[-1], None)
+        return base
+
+    def __split(self, item):
+        """Pop track fields from a copy of item, return (scaled values, static part)."""
+        item = ujson.loads(ujson.dumps(item))
+        values = []
+        for path, scale, kind in self.__fields:
+            node = item
+            for key in path[:-1]:
+                node = node.get(key) if isinstance(node, dict) else None
+            val = node.pop(path[-1], None) if isinstance(node, dict) else None
+            if isinstance(val, (int, float)):
+                val = int(round(val * scale)) if kind == "f" else int(val) // scale
+            else:
+                val = None
+            values.append(val)
+        return values, item
+
+    def __template(self, static):
+        """Find template id of static part, add a new template if diff is large."""
+        size = len(ujson.dumps(static))
+        if self.__last_id in self.__templates:
+            removed = []
+            diff = self.__diff(self.__templates[self.__last_id], static, removed)
+            if len(ujson.dumps([diff, removed])) <= size * self.__max_diff_ratio:
+                return self.__last_id, diff, removed
+        if len(self.__templates) >= self.__max_templates:
+            return 0, static, []
+        self.__last_id += 1
+        self.__templates[self.__last_id] = static
+        if not self.__save():
+            self.__templates.pop(self.__last_id)
+            self.__last_id -= 1
+            return 0, static, []
+        return self.__last_id, {}, []
+
+    def encode(self, data):
+        """Encode track points list to segment bytes."""
+        buf = bytearray([self.VERSION])
+        self.__put_varint(buf, len(data))
+        prev = [0] * len(self.__fields)
+        for item in data:
+            values, static = self.__split(item)
+            tpl_id, diff, removed = self.__template(static)
+            self.__put_varint(buf, tpl_id)
+            mask = 0
+            for i, val in enumerate(values):
+                if val is not None:
+                    mask |= 1 << i
+            self.__put_varint(buf, mask)
+            for i, val in enumerate(values):
+                if val is not None:
+                    self.__put_varint(buf, self.__zigzag(val - prev[i]))
+                    prev[i] = val
+            diff = ujson.dumps([diff, removed]).encode() if diff or removed else b""
+            self.__put_varint(buf, len(diff))
+            buf.extend(diff)
+        return bytes(buf)
+
+    def decode(self, data):
+        """Decode segment bytes to track points list, JSON list records are decoded as JSON."""
+        if data[:1] == b"[":
+            return ujson.loads(data)
+        version = data[0]
+        pos = 1
+        count, pos = self.__get_varint(data, pos)
+        prev = [0] * len(self.__fields)
+        res = []
+        for _ in range(count):
+            tpl_id, pos = self.__get_varint(data, pos)
+            mask, pos = self.__get_varint(data, pos)
+            values = []
+            for i in range(len(self.__fields)):
+                if mask & (1 << i):
+                    val, pos = self.__get_varint(data, pos)
+                    prev[i] += self.__unzigzag(val)
+                    values.append(prev[i])
+                else:
+                    values.append(None)
+            length, pos = self.__get_varint(data, pos)
+            diff = ujson.loads(data[pos:pos + length].decode()) if length else {}
+            pos += length
+            removed = []
+            if version < 2:
+                self.__legacy_removed(diff, removed)
+            elif diff:
+                diff, removed = diff
+            item = ujson.loads(ujson.dumps(self.__templates[tpl_id])) if tpl_id else {}
+            item = self.__patch(item, diff, removed)
+            for (path, scale, kind), val in zip(self.__fields, values):
+                if val is None:
+                    continue
+                node = item
+                for key in path[:-1]:
+                    node = node.setdefault(key, {})
+                node[path[-1]] = val / scale if kind == "f" else val * scale
+            res.append(item)
+        return res
+
+    def clean(self):
+        """Remove templates, called when all history is consumed."""
+        self.__templates = {}
+        self.__last_id = 0
+        for i in (self.__template_file, self.__template_file + ".tmp"):
+            if ql_fs.path_exists(i):
+                uos.remove(i)
+
+
+class HistoryRing:
+    """This class is for manage history in a binary ring buffer file.
+
+    The file is preallocated with fixed size slots, append and pop write one slot and the header.
+    When the ring is full, the oldest record is overwritten.
+    It is meant for small fixed size records such as `Fix` by `FixCodec`, the default slot
+    can not hold a tracker property dict by `JSONCodec`, which needs about 2 KB slots.
+    The header has two copies written in turn, the valid one with larger sequence is used on load,
+    so power lost while writing header falls back to the previous state.
+        header: b"HRNG", version (u16), slot size (u16), slot number (u32), head (u32), tail (u32), count (u32),
+                sequence (u32), header CRC-32 (u32)
+        slot: payload length (u16), payload CRC-32 (u32), payload, zero padding
+    """
+
+    MAGIC = b"HRNG"
+    VERSION = 2
+    __HEADER_FMT = ">4sHHIIIII"
+    __HEADER_SIZE = ustruct.calcsize(__HEADER_FMT) + 4
+    __SLOT_HEADER_FMT = ">HI"
+    __SLOT_HEADER_SIZE = ustruct.calcsize(__SLOT_HEADER_FMT)
+
+    def __init__(self, history_file="/usr/tracker_data.ring", capacity=0x10000, slot_size=256, codec=None):
+        """
+        Parameter:
+            history_file: filename include full path
+            capacity: history file size, unit: byte
+            slot_size: one record slot size include slot header, unit: byte, 256 fits `FixCodec` records
+            codec: record codec object with `encode(item)` and `decode(bytes)`, default is `JSONCodec`
+        """
+        self.__history = history_file
+        self.__slot_size = slot_size
+        self.__slots = (capacity - self.__HEADER_SIZE * 2) // slot_size
+        self.__codec = codec if codec else JSONCodec
+        self.__head = 0
+        self.__tail = 0
+        self.__count = 0
+        self.__seq = 0
+        # Record count overwritten when full, to correct a commit of a page read before overwrite.
+        self.__dropped = 0
+        self.__peek_dropped = 0
+        self.__history_lock = _thread.allocate_lock()
+        self.__load()
+
+    @property
+    def slots(self):
+        return self.__slots
+
+    @property
+    def count(self):
+        return self.__count
+
+    def __load(self):
+        """Load header, create the file if not exists or its geometry is changed."""
+        try:
+            if ql_fs.path_exists(self.__history):
+                with open(self.__history, "rb") as f:
+                    headers = (f.read(self.__HEADER_SIZE), f.read(self.__HEADER_SIZE))
+                valid = None
+                for header in headers:
+                    if len(header) != self.__HEADER_SIZE or \
+                            crc32(header[:-4]) != ustruct.unpack(">I", header[-4:])[0]:
+                        continue
+                    magic, version, slot_size, slots, head, tail, count, seq = ustruct.unpack(self.__HEADER_FMT, header[:-4])
+                    if magic == self.MAGIC and version == self.VERSION and slot_size == self.__slot_size and \
+                            slots == self.__slots and head < slots and tail < slots and count <= slots:
+                        if valid is None or seq > valid[3]:
+                            valid = (head, tail, count, seq)
+                if valid is not None:
+                    self.__head, self.__tail, self.__count, self.__seq = valid
+                    return
+                log.warn("HistoryRing %s has no valid header or format changed, recreate it." % self.__history)
+            self.__create()
+        except Exception as e:
+            sys.print_exception(e)
+
+    def __create(self):
+        self.__head = 0
+        self.__tail = 0
+        self.__count = 0
+        self.__seq = 0
+        blank = bytes(self.__slot_size)
+        with open(self.__history, "wb") as f:
+            f.write(bytes(self.__HEADER_SIZE * 2))
+            for i in range(self.__slots):
+                f.write(blank)
+            self.__write_header(f)
+
+    def __write_header(self, f):
+        """Write header to the older copy."""
+        self.__seq += 1
+        header = ustruct.pack(
+            self.__HEADER_FMT, self.MAGIC, self.VERSION, self.__slot_size,
+            self.__slots, self.__head, self.__tail, self.__count, self.__seq
+        )
+        f.seek((self.__seq % 2) * self.__HEADER_SIZE)
+        f.write(header)
+        f.write(ustruct.pack(">I", crc32(header)))
+
+    def __slot_offset(self, index):
+        return self.__HEADER_SIZE * 2 + index * self.__slot_size
+
+    def __read_slot(self, f, index):
+        f.seek(self.__slot_offset(index))
+        slot = f.read(self.__slot_size)
+        length, crc = ustruct.unpack(self.__SLOT_HEADER_FMT, slot[:self.__SLOT_HEADER_SIZE])
+        payload = slot[self.__SLOT_HEADER_SIZE:self.__SLOT_HEADER_SIZE + length]
+        if len(payload) != length or crc32(payload) != crc:
+            log.warn("HistoryRing slot %s crc check failed." % index)
+            return None
+        return self.__codec.decode(payload)
 
     def read(self):
-        """Read history info
+        """Read and pop all history info
 
         Return:
             data (dict): history data.
@@ -106,12 +1011,72 @@ class History:
                 }
         """
         with self.__history_lock:
-            res = self.__read()
-            self.__write({"data": []})
+            res = {"data": []}
+            if not self.__count:
+                return res
+            try:
+                with open(self.__history, "r+b") as f:
+                    for i in range(self.__count):
+                        item = self.__read_slot(f, (self.__head + i) % self.__slots)
+                        if item is not None:
+                            res["data"].append(item)
+                    self.__head = self.__tail
+                    self.__count = 0
+                    self.__write_header(f)
+            except Exception as e:
+                sys.print_exception(e)
             return res
 
+    def peek(self, num=10):
+        """Read history data from head without popping it, call `commit` after the page is reported.
+
+        Args:
+            num (int): max data count of this page.
+
+        Returns:
+            list: history data list, a broken slot is returned as None.
+        """
+        with self.__history_lock:
+            res = []
+            self.__peek_dropped = self.__dropped
+            try:
+                with open(self.__history, "rb") as f:
+                    for i in range(min(num, self.__count)):
+                        res.append(self.__read_slot(f, (self.__head + i) % self.__slots))
+            except Exception as e:
+                sys.print_exception(e)
+            return res
+
+    def commit(self, count):
+        """Pop history data reported from the last `peek`.
+
+        Args:
+            count (int): data count reported from the head of the last page.
+
+        Returns:
+            bool: True - success, False - faliled.
+        """
+        with self.__history_lock:
+            count -= self.__dropped - self.__peek_dropped
+            self.__peek_dropped = self.__dropped
+            count = min(count, self.__count)
+            if count <= 0:
+                return True
+            try:
+                self.__head = (self.__head + count) % self.__slots
+                self.__count -= count
+                with open(self.__history, "r+b") as f:
+                    self.__write_header(f)
+                return True
+            except Exception as e:
+                sys.print_exception(e)
+                return False
+
     def write(self, data):
-        """Data format for write history
+        """Append history data, one slot per item.
+
+        All or nothing, every item is encoded and size checked before any slot is written,
+        and the header is written once after all slots, so a failed write keeps the ring unchanged.
 
         Args:
             data (list): history data list.
@@ -120,21 +1085,161 @@ class History:
             bool: True - success, False - faliled.
         """
         with self.__history_lock:
-            res = self.__read()
-            res["data"].extend(data)
-            if len(res["data"]) > self.__max_hist_num:
-                res["data"] = res["data"][self.__max_hist_num * -1:]
-            return self.__write(res)
+            head, tail, count, dropped = self.__head, self.__tail, self.__count, self.__dropped
+            try:
+                payloads = [self.__codec.encode(item) for item in data]
+                for payload in payloads:
+                    if self.__SLOT_HEADER_SIZE + len(payload) > self.__slot_size:
+                        log.error("HistoryRing record size %s over slot size %s." % (len(payload), self.__slot_size))
+                        return False
+                with open(self.__history, "r+b") as f:
+                    for payload in payloads:
+                        f.seek(self.__slot_offset(self.__tail))
+                        f.write(ustruct.pack(self.__SLOT_HEADER_FMT, len(payload), crc32(payload)))
+                        f.write(payload)
+                        self.__tail = (self.__tail + 1) % self.__slots
+                        if self.__count == self.__slots:
+                            self.__head = (self.__head + 1) % self.__slots
+                            self.__dropped += 1
+                        else:
+                            self.__count += 1
+                    self.__write_header(f)
+                return True
+            except Exception as e:
+                sys.print_exception(e)
+                self.__head, self.__tail, self.__count, self.__dropped = head, tail, count, dropped
+                return False
 
     def clean(self):
-        """Remove history file.
+        """Drop all history data.
 
         Returns:
             bool: True - success, False - faliled.
         """
         with self.__history_lock:
             try:
-                uos.remove(self.__history)
+                self.__head = 0
+                self.__tail = 0
+                self.__count = 0
+                with open(self.__history, "r+b") as f:
+                    self.__write_header(f)
                 return True
-            except:
+            except Exception as e:
+                sys.print_exception(e)
                 return False
+
+
+class HistoryCache:
+    """This class is for staging history writes in RAM in front of `History` or `HistoryRing`.
+
+    Staged data are written to the backend in one write when over `max_num` or `max_bytes`,
+    before any read of the backend, and by `flush` before sleep or power down.
+    Data lost by a crash are at most the staged data.
+    If the write fails, items are written one by one, written items are unstaged and an item
+    rejected while others are written is dropped. Data left staged are capped to `max_num` items
+    and `max_bytes`, the oldest are dropped.
+    """
+
+    def __init__(self, history, max_num=10, max_bytes=4096):
+        """
+        Parameter:
+            history: history backend object, `History` or `HistoryRing`
+            max_num: staged data max count
+            max_bytes: staged data max JSON size, unit: byte
+        """
+        self.__history = history
+        self.__max_num = max_num
+        self.__max_bytes = max_bytes
+        self.__data = []
+        self.__bytes = 0
+        self.__cache_lock = _thread.allocate_lock()
+
+    @property
+    def history(self):
+        return self.__history
+
+    def __flush(self):
+        if not self.__data:
+            return True
+        if self.__history.write(self.__data):
+            self.__data = []
+            self.__bytes = 0
+            return True
+        failed = []
+        written = False
+        for item in self.__data:
+            if self.__history.write([item]):
+                written = True
+            else:
+                failed.append(item)
+        if written and failed:
+            log.error("HistoryCache drop %s items rejected by backend." % len(failed))
+            failed = []
+        self.__data = failed
+        self.__bytes = sum([len(ujson.dumps(i)) for i in failed])
+        while self.__data and (len(self.__data) > self.__max_num or self.__bytes > self.__max_bytes):
+            log.warn("HistoryCache is full, drop the oldest staged item.")
+            self.__bytes -= len(ujson.dumps(self.__data.pop(0)))
+        return not self.__data
+
+    def flush(self):
+        """Write staged data to the backend and flush the backend if it can.
+
+        Returns:
+            bool: True - success, False - faliled.
+        """
+        with self.__cache_lock:
+            res = self.__flush()
+            if hasattr(self.__history, "flush"):
+                res = self.__history.flush() and res
+            return res
+
+    def write(self, data):
+        """Stage history data, flush if over threshold.
+
+        Args:
+            data (list): history data list.
+
+        Returns:
+            bool: True - success, False - faliled.
+        """
+        with self.__cache_lock:
+            self.__data.extend(data)
+            self.__bytes += sum([len(ujson.dumps(i)) for i in data])
+            if len(self.__data) >= self.__max_num or self.__bytes >= self.__max_bytes:
+                return self.__flush()
+            return True
+
+    def read(self):
+        with self.__cache_lock:
+            self.__flush()
+            return self.__history.read()
+
+    def peek(self, num=10):
+        with self.__cache_lock:
+            self.__flush()
+            return self.__history.peek(num)
+
+    def commit(self, count):
+        return self.__history.commit(count)
+
+    def diagnostics(self):
+        """Get backend diagnostics with staged data count.
+
+        Returns:
+            dict: backend diagnostics and {"staged": staged data count}
+        """
+        res = self.__history.diagnostics() if hasattr(self.__history, "diagnostics") else {}
+        res["staged"] = len(self.__data)
+        return res
+
+    def query(self, start, end, num=10, token=None):
+        with self.__cache_lock:
+            self.__flush()
+            return self.__history.query(start, end, num, token)
+
+    def clean(self):
+        with self.__cache_lock:
+            self.__data = []
+            self.__bytes = 0
+            return self.__history.clean()
@@ -35,15 +35,22 @@
 @copyright :Copyright (c) 2022
 """
 
-import ure
+import net
+import uos
 import math
+import ql_fs
 import utime
+import ustruct
 import osTimer
 import _thread
 try:
     import quecgnss
 except ImportError:
     quecgnss = None
+try:
+    import wifiScan
+except ImportError:
+    wifiScan = None
 import cellLocator
 import usys as sys
 
@@ -52,12 +59,13 @@ from machine import UART, Pin
 from wifilocator import wifilocator
 
 from usr.modules.logging import getLogger
-from usr.modules.common import option_lock
+from usr.modules.common import option_lock, ThreadPool
 
 
 log = getLogger(__name__)
 
 _gps_data_set_lock = _thread.allocate_lock()
+_gps_data_check_lock = _thread.allocate_lock()
 
 CRLF = "\r\n"
 
@@ -97,75 +105,196 @@ class CoordinateSystemConvert:
         return lon02, lat02
 
 
+def _distance(lon1, lat1, lon2, lat2):
+    """Approximate distance of two WGS84 positions in meters, for short distances."""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.sqrt(x * x + y * y) * 6371000
+
+
+class Fix:
+    """Compact location fix record shared by GNSS, locators, tracker and history.
+
+    Attributes:
+        lat, lon (float): WGS84 degrees.
+        alt (float): altitude, unit: m.
+        speed (float): ground speed, unit: km/h.
+        course (float): ground heading, unit: degree.
+        hdop (float): horizontal dilution of precision.
+        sats (int): satellites in use.
+        utc (int): fix time, seconds by `utime.mktime` of the GNSS UTC date and time.
+        source (str): `gnss`, `cell` or `wifi`.
+        policy (str): GNSS fix acceptance policy name.
+    """
+
+    __slots__ = ("lat", "lon", "alt", "speed", "course", "hdop", "sats", "utc", "source", "policy")
+
+    # lat, lon (1e-7 degree), alt (cm), speed (0.01 km/h), course (0.01 degree), hdop (0.01), sats, source, utc
+    _PACK_FMT = "<iiiHHHBBI"
+    _PACK_SIZE = ustruct.calcsize(_PACK_FMT)
+    _SOURCES = ("gnss", "cell", "wifi")
+
+    def __init__(self, lat=None, lon=None, alt=None, speed=None, course=None, hdop=None, sats=None, utc=None,
+                 source="gnss", policy=None):
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.speed = speed
+        self.course = course
+        self.hdop = hdop
+        self.sats = sats
+        self.utc = utc
+        self.source = source
+        self.policy = policy
+
+    def to_list(self):
+        """list: fields in `__slots__` order, for compact JSON."""
+        return [self.lat, self.lon, self.alt, self.speed, self.course, self.hdop, self.sats, self.utc, self.source, self.policy]
+
+    @classmethod
+    def from_list(cls, data):
+        return cls(*data)
+
+    def pack(self):
+        """Pack to fixed size bytes, missing values are saved as the max value of the field.
+
+        Returns:
+            bytes: packed fix, `Fix._PACK_SIZE` bytes.
+        """
+        def _scale(val, scale, missing):
+            return missing if val is None else int(round(val * scale))
+
+        return ustruct.pack(
+            self._PACK_FMT,
+            _scale(self.lat, 10000000, -0x80000000),
+            _scale(self.lon, 10000000, -0x80000000),
+            _scale(self.alt, 100, -0x80000000),
+            _scale(self.speed, 100, 0xFFFF),
+            _scale(self.course, 100, 0xFFFF),
+            _scale(self.hdop, 100, 0xFFFF),
+            0xFF if self.sats is None else self.sats,
+            self._SOURCES.index(self.source) if self.source in self._SOURCES else 0xFF,
+            self.utc or 0,
+        )
+
+    @classmethod
+    def unpack(cls, data):
+        def _scale(val, scale, missing):
+            return None if val == missing else val / scale
+
+        lat, lon, alt, speed, course, hdop, sats, source, utc = ustruct.unpack(cls._PACK_FMT, data)
+        return cls(
+            lat=_scale(lat, 10000000, -0x80000000),
+            lon=_scale(lon, 10000000, -0x80000000),
+            alt=_scale(alt, 100, -0x80000000),
+            speed=_scale(speed, 100, 0xFFFF),
+            course=_scale(course, 100, 0xFFFF),
+            hdop=_scale(hdop, 100, 0xFFFF),
+            sats=None if sats == 0xFF else sats,
+            utc=utc or None,
+            source=cls._SOURCES[source] if source < len(cls._SOURCES) else None,
+        )
+
+
+class FixCodec:
+    """History record codec for `Fix`, 24 bytes per record."""
+
+    @staticmethod
+    def encode(item):
+        return item.pack()
+
+    @staticmethod
+    def decode(data):
+        return Fix.unpack(data)
+
+
 class NMEAParse:
-    """This class is match and parse gps NEMA 0183"""
+    """This class is match and parse gps NEMA 0183
+
+    The NMEA text is tokenized once in `set_gps_data` and the sentences are
+    indexed by type, so every property below is a dict lookup.
+    """
 
     def __init__(self):
-        self.__gps_data = ""
+        self.__sentences = {}
+        self.__fields = {}
 
     def __parse(self, nmea):
         return tuple(nmea[1:].split("*")[0].split(",")) if nmea else ()
 
+    def __sentence(self, key):
+        return self.__sentences.get(key, "")
+
+    def __data(self, key):
+        fields = self.__fields.get(key)
+        if fields is None:
+            fields = self.__parse(self.__sentences.get(key))
+            self.__fields[key] = fields
+        return fields
+
     def set_gps_data(self, gps_data):
-        self.__gps_data = gps_data
+        """Split NMEA text into sentences and index the latest one of each type.
+
+        The first sentence of a type is the one indexed, GNSS hands over only
+        the latest sentence of each type.
+
+        Args:
+            gps_data (str): NMEA 0183 text.
+        """
+        sentences = {}
+        if gps_data:
+            for nmea in gps_data.split("$"):
+                nmea = nmea.strip()
+                # Talker `Gx` and three letters sentence type, e.g. `GNRMC,`.
+                if len(nmea) > 6 and nmea[0] == "G" and nmea[5] == ",":
+                    key = nmea[2:5]
+                    if key not in sentences:
+                        sentences[key] = "$" + nmea
+        self.set_sentences(sentences)
+
+    def set_sentences(self, sentences):
+        """Set already indexed sentences.
+
+        Args:
+            sentences (dict): sentence type (`RMC`, `GGA`, ...) to NMEA sentence.
+        """
+        self.__sentences = sentences
+        self.__fields = {}
 
     @property
     def GxRMC(self):
-        if self.__gps_data:
-            rmc_re = ure.search(
-                r"\$G[NP]RMC,\d*\.*\d*,*[AV],*\d*\.*\d*,*[NS],*\d*\.*\d*,*[EW],*\d*\.*\d*,*\d*\.*\d*,*\d*,*\d*\.*\d*,*[EW]*,*[ADEN]*,*[SCUV]*\**(\d|\w)*",
-                self.__gps_data)
-            if rmc_re:
-                return rmc_re.group(0)
-        return ""
+        return self.__sentence("RMC")
 
     @property
     def GxGGA(self):
-        if self.__gps_data:
-            gga_re = ure.search(
-                r"\$G[BLPN]GGA,\d*\.*\d*,*\d*\.*\d*,*[NS],*\d*\.*\d*,*[EW],*[0126],*\d*,*\d*\.*\d*,*-*\d*\.*\d*,*M,*-*\d*\.*\d*,*M,*\d*,*\**(\d|\w)*",
-                self.__gps_data)
-            if gga_re:
-                return gga_re.group(0)
-        return ""
+        return self.__sentence("GGA")
 
     @property
     def GxVTG(self):
-        if self.__gps_data:
-            vtg_re = ure.search(
-                r"\$G[NP]VTG,\d*\.*\d*,*T,*\d*\.*\d*,*M,*\d*\.*\d*,*N,*\d*\.*\d*,*K,*[ADEN]*\*(\d|\w)*",
-                self.__gps_data)
-            if vtg_re:
-                return vtg_re.group(0)
-        return ""
+        return self.__sentence("VTG")
 
     @property
     def GxGSV(self):
-        if self.__gps_data:
-            gsv_re = ure.search(
-                r"\$G[NP]GSV,\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*\**(\d|\w)*",
-                self.__gps_data)
-            if gsv_re:
-                return gsv_re.group(0)
-        return ""
+        return self.__sentence("GSV")
 
     @property
     def GxGLL(self):
-        if self.__gps_data:
-            gll_re = ure.search(
-                r"\$G[NP]GLL,\d*\.*\d*,*[NS]*,*\d*\.*\d*,*[EW]*,*\d*\.*\d*,*[AV]*,*[ADEN]*\**(\d|\w)*",
-                self.__gps_data)
-            if gll_re:
-                return gll_re.group(0)
+        return self.__sentence("GLL")
 
     @property
     def GxGSA(self):
-        if self.__gps_data:
-            gsa_re = ure.search(
-                r"\$G[NP]GSA,[MA]*,*[123]*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*,*\d*\.*\d*,*\d*\.*\d*,*\d*\.*\d*,*(\d|\w)*\**(\d|\w)*",
-                self.__gps_data)
-            if gsa_re:
-                return gsa_re.group(0)
+        return self.__sentence("GSA")
+
+    def GxData(self, key):
+        """Get fields of the indexed sentence by type.
+
+        Args:
+            key (str): sentence type, e.g. `RMC`.
+
+        Returns:
+            tuple: sentence fields, empty if this type is not indexed.
+        """
+        return self.__data(key)
 
     @property
     def GxRMCData(self):
@@ -177,33 +306,76 @@ class NMEAParse:
                 ground rate, ground heading, UTC date, magnetic declination, Magnetic declination direction, Mode indication
             )
         """
-        return self.__parse(self.GxRMC)
+        return self.__data("RMC")
 
     @property
     def GxGGAData(self):
-        return self.__parse(self.GxGGA)
+        return self.__data("GGA")
 
     @property
     def GxGSVData(self):
-        return self.__parse(self.GxGSV)
+        return self.__data("GSV")
 
     @property
     def GxGSAData(self):
-        return self.__parse(self.GxGSA)
+        return self.__data("GSA")
 
     @property
     def GxVTGData(self):
-        return self.__parse(self.GxVTG)
+        return self.__data("VTG")
 
     @property
     def GxGLLData(self):
-        return self.__parse(self.GxGLL)
+        return self.__data("GLL")
+
+    def __degree(self, value, hemisphere, width):
+        """Convert NMEA `(d)ddmm.mmmm` to signed degrees."""
+        deg = float(value[:width]) + float(value[width:]) / 60
+        return deg if hemisphere in ("N", "E") else -deg
+
+    def __float(self, fields, index):
+        return float(fields[index]) if len(fields) > index and fields[index] else None
+
+    @property
+    def fix(self):
+        """Build fix record from the indexed sentences.
+
+        Position is taken from GGA, or RMC when GGA is not indexed.
+
+        Returns:
+            Fix/None: fix record, None if no valid position.
+        """
+        _rmc = self.GxRMCData
+        _gga = self.GxGGAData
+        if len(_gga) > 9 and _gga[2] and _gga[4]:
+            pos = _gga
+        elif len(_rmc) > 6 and _rmc[2] == "A" and _rmc[3] and _rmc[5]:
+            pos = _rmc[1:]
+        else:
+            return None
+        try:
+            fix = Fix(lat=self.__degree(pos[2], pos[3], 2), lon=self.__degree(pos[4], pos[5], 3))
+            fix.alt = self.__float(_gga, 9)
+            fix.hdop = self.__float(_gga, 8)
+            fix.sats = int(_gga[7]) if len(_gga) > 7 and _gga[7] else None
+            fix.speed = self.__float(self.GxVTGData, 7)
+            if fix.speed is None and len(_rmc) > 7 and _rmc[7]:
+                fix.speed = float(_rmc[7]) * 1.852
+            fix.course = self.__float(_rmc, 8)
+            if len(_rmc) > 9 and len(_rmc[9]) == 6 and len(_rmc[1]) >= 6:
+                fix.utc = utime.mktime((
+                    2000 + int(_rmc[9][4:6]), int(_rmc[9][2:4]), int(_rmc[9][0:2]),
+                    int(_rmc[1][0:2]), int(_rmc[1][2:4]), int(_rmc[1][4:6]), 0, 0
+                ))
+        except ValueError:
+            return None
+        return fix
 
     @property
     def Latitude(self):
         lat = ""
         _gga = self.GxGGAData
-        if _gga:
+        if len(_gga) > 3 and _gga[2]:
             lat = _gga[2]
             lat = str(float(lat[:2]) + float(lat[2:]) / 60)
             lat = ("" if _gga[3] == "N" else "-") + lat
@@ -213,7 +385,7 @@ class NMEAParse:
     def Longitude(self):
         lng = ""
         _gga = self.GxGGAData
-        if _gga:
+        if len(_gga) > 5 and _gga[4]:
             lng = _gga[4]
             lng = str(float(lng[:3]) + float(lng[3:]) / 60)
             lng = ("" if _gga[5] == "E" else "-") + lng
@@ -222,16 +394,206 @@ class NMEAParse:
     @property
     def Altitude(self):
         _gga = self.GxGGAData
-        alt = _gga[9] if _gga else ""
+        alt = _gga[9] if len(_gga) > 9 else ""
         return alt
 
     @property
     def Speed(self):
         _vtg = self.GxVTGData
-        speed = _vtg[7] if _vtg else ""
+        speed = _vtg[7] if len(_vtg) > 7 else ""
         return speed
 
 
+class NMEAAssembler:
+    """Streaming NMEA line assembler with a fixed byte capacity.
+
+    UART / quecgnss chunks are fed as bytes, a partial sentence is kept in a
+    preallocated line buffer across chunks and only the latest complete
+    sentence of each type is held, so memory does not grow while waiting fix.
+
+    The XOR checksum is accumulated while the bytes arrive, sentences with a
+    missing or wrong checksum are dropped and counted per sentence type.
+    """
+
+    def __init__(self, capacity=128, max_types=16):
+        """
+        Parameter:
+            capacity: max bytes of one sentence, longer sentences are dropped.
+            max_types: max count of sentence types held.
+        """
+        self.__line = bytearray(capacity)
+        self.__capacity = capacity
+        self.__max_types = max_types
+        self.__size = -1
+        self.__xor = 0
+        self.__star = 0
+        self.__sentences = {}
+        self.__rejected = {}
+        self.__seq = {}
+
+    def __reject(self, size):
+        key = bytes(self.__line[3:6]).decode() if size >= 6 else "---"
+        self.__rejected[key] = self.__rejected.get(key, 0) + 1
+
+    def __complete(self, size, xor, star):
+        line = self.__line
+        # `$GxXXX,` is the shortest sentence head.
+        if size < 7 or line[6] != 0x2C:
+            return False
+        # Sentence must end with `*` and two hex digits of the XOR checksum.
+        try:
+            valid = star > 0 and size == star + 3 and int(bytes(line[star + 1:size]).decode(), 16) == xor
+        except ValueError:
+            valid = False
+        if not valid:
+            self.__reject(size)
+            return False
+        sentence = bytes(line[:size]).decode()
+        key = sentence[3:6]
+        if key not in self.__sentences and len(self.__sentences) >= self.__max_types:
+            return False
+        self.__sentences[key] = sentence
+        self.__seq[key] = self.__seq.get(key, 0) + 1
+        return True
+
+    def feed(self, data):
+        """Feed a chunk of NMEA data.
+
+        Args:
+            data (bytes): NMEA bytes read from GNSS.
+
+        Returns:
+            int: count of valid sentences completed by this chunk.
+        """
+        count = 0
+        line = self.__line
+        capacity = self.__capacity
+        size = self.__size
+        xor = self.__xor
+        star = self.__star
+        for b in data:
+            if b == 0x24:  # `$`, start of a new sentence.
+                line[0] = b
+                size = 1
+                xor = 0
+                star = 0
+            elif size < 0:
+                continue
+            elif b == 0x0D or b == 0x0A:
+                if self.__complete(size, xor, star):
+                    count += 1
+                size = -1
+            elif size >= capacity:
+                # Sentence overflow, drop it and wait for the next `$`.
+                self.__reject(size)
+                size = -1
+            else:
+                line[size] = b
+                if star == 0:
+                    if b == 0x2A:  # `*`, checksum digits follow.
+                        star = size
+                    else:
+                        xor ^= b
+                size += 1
+        self.__size = size
+        self.__xor = xor
+        self.__star = star
+        return count
+
+    def clear(self):
+        self.__size = -1
+        self.__sentences = {}
+
+    @property
+    def sentences(self):
+        """dict: sentence type (`RMC`, `GGA`, ...) to the latest NMEA sentence."""
+        return dict(self.__sentences)
+
+    def seq(self, key):
+        """Count of valid sentences of this type assembled, it only goes up.
+
+        Args:
+            key (str): sentence type, e.g. `RMC`.
+
+        Returns:
+            int: sentence sequence number.
+        """
+        return self.__seq.get(key, 0)
+
+    @property
+    def rejected(self):
+        """dict: sentence type to count of sentences dropped as corrupt."""
+        return dict(self.__rejected)
+
+    @property
+    def data(self):
+        """str: the latest sentences joined by CRLF."""
+        return CRLF.join(self.__sentences.values())
+
+
+class GNSSFixPolicy:
+    """GNSS fix acceptance policy.
+
+    A read ends as soon as RMC reports a valid position and the policy is met, e.g.
+        first valid RMC: GNSSFixPolicy("first_rmc", nmea=0b000001)
+        RMC + GGA, HDOP < 2.0, >= 5 satellites: GNSSFixPolicy("rmc_gga", nmea=0b000011, max_hdop=2.0, min_sats=5)
+    """
+
+    RMC = 0
+    GGA = 1
+    GSV = 2
+    GSA = 3
+    VTG = 4
+    GLL = 5
+
+    __KEYS = ("RMC", "GGA", "GSV", "GSA", "VTG", "GLL")
+
+    def __init__(self, name="nmea", nmea=0b010111, max_hdop=None, min_sats=None):
+        """
+        Parameter:
+            name: policy name reported with the fix.
+            nmea: bitmask of the sentences required, bit index as RMC, GGA, GSV, GSA, VTG, GLL.
+            max_hdop: GGA HDOP must be less than it, None for no limit.
+            min_sats: GGA satellites in use must be no less than it, None for no limit.
+        """
+        self.__name = name
+        self.__nmea = nmea | (0b1 << self.RMC)
+        if max_hdop is not None or min_sats is not None:
+            self.__nmea |= 0b1 << self.GGA
+        self.__max_hdop = max_hdop
+        self.__min_sats = min_sats
+
+    @property
+    def name(self):
+        return self.__name
+
+    def check(self, nmea_parse):
+        """Check the indexed sentences meet this policy.
+
+        Args:
+            nmea_parse (NMEAParse): parser holding the latest sentences.
+
+        Returns:
+            bool: True - fix is accepted, False - not.
+        """
+        _rmc = nmea_parse.GxRMCData
+        if len(_rmc) < 3 or _rmc[2] != "A":
+            return False
+        for i, key in enumerate(self.__KEYS):
+            if self.__nmea & (0b1 << i) and not nmea_parse.GxData(key):
+                return False
+        if self.__max_hdop is not None or self.__min_sats is not None:
+            _gga = nmea_parse.GxGGAData
+            try:
+                if self.__max_hdop is not None and not float(_gga[8]) < self.__max_hdop:
+                    return False
+                if self.__min_sats is not None and int(_gga[7]) < self.__min_sats:
+                    return False
+            except (IndexError, ValueError):
+                return False
+        return True
+
+
 class GNSSPower:
 
     def __init__(self, PowerPin, StandbyPin, BackupPin):
@@ -283,19 +645,23 @@ class GNSSPower:
 
 class GNSS(GNSSPower):
 
-    __RMC = 0
-    __GGA = 1
-    __GSV = 2
-    __GSA = 3
-    __VTG = 4
-    __GLL = 5
-
     class _gps_mode:
         none = 0x0
         internal = 0x1
         external = 0x2
 
-    def __init__(self, UARTn, buadrate, databits, parity, stopbits, flowctl, gps_mode, nmea, PowerPin, StandbyPin, BackupPin):
+    class _gps_sleep_mode:
+        none = 0x0
+        pull_off = 0x1
+        backup = 0x2
+        standby = 0x3
+
+    # Seconds the retained ephemeris / almanac are usable for hot / warm start.
+    __HOT_START_AGE = 2 * 3600
+    __WARM_START_AGE = 7 * 24 * 3600
+
+    def __init__(self, UARTn, buadrate, databits, parity, stopbits, flowctl, gps_mode, nmea, PowerPin, StandbyPin, BackupPin,
+                 gps_sleep_mode=_gps_sleep_mode.none, fix_policy=None):
         super().__init__(PowerPin, StandbyPin, BackupPin)
         self.__UARTn = UARTn
         self.__buadrate = buadrate
@@ -305,61 +671,146 @@ class GNSS(GNSSPower):
         self.__flowctl = flowctl
         self.__gps_mode = gps_mode
         self.__NMEA = nmea if nmea else 0b010111
+        self.__gps_sleep_mode = gps_sleep_mode
+        # Default policy and a policy without `nmea` wait every enabled NMEA sentence.
+        fix_policy = dict(fix_policy) if fix_policy else {}
+        if fix_policy.get("nmea") is None:
+            fix_policy["nmea"] = self.__NMEA
+        self.__fix_policy = GNSSFixPolicy(**fix_policy)
+
+        self.__retained = False
+        self.__last_fix_time = None
+        self.__start_type = "cold"
+        self.__open_ticks = 0
+        self.__ttff = {}
 
         self.__external_obj = None
         self.__internal_obj = quecgnss
         self.__nmea_parse = NMEAParse()
 
         self.__external_retrieve_queue = None
+        self.__external_buf = None
+        self.__external_view = None
+        self.__external_reading = False
         self.__queue_size = 2
+        self.__stream_running = False
+        self.__stream_callback = None
+        self.__stream_queue = None
+        self.__stream_rate = 1
+        self.__stream_count = 0
+        self.__stream_seq = (0, 0)
+        self.__stream_parse = NMEAParse()
         self.__first_break = 0
         self.__break = 0
-        self.__gps_data = ""
-        self.__rmc_data = ""
-        self.__gga_data = ""
-        self.__vtg_data = ""
-        self.__gsv_data = ""
+        # Set by `cancel`, kept apart from `__break` which `__internal_read` resets between its loops.
+        self.__cancel = 0
+        self.__assembler = NMEAAssembler()
 
         self.__gps_timer = osTimer()
         self.__gps_data_check_timer = osTimer()
 
+        self.__external_retrieve_queue = Queue(maxsize=self.__queue_size)
         if self.__gps_mode == self._gps_mode.external:
             self.__external_init()
         elif self.__gps_mode == self._gps_mode.internal:
             self.__internal_init()
 
     @option_lock(_gps_data_set_lock)
-    def __set_gps_data(self, gps_data):
-        self.__gps_data = gps_data
+    def __feed_gps_data(self, this_gps_data):
+        return self.__assembler.feed(this_gps_data) if this_gps_data else 0
+
+    @option_lock(_gps_data_set_lock)
+    def __clear_gps_data(self):
+        self.__assembler.clear()
 
     @option_lock(_gps_data_set_lock)
     def __get_gps_data(self):
-        return self.__gps_data
-
-    def __reverse_gps_data(self, this_gps_data):
-        log.debug("this_gps_data: \n%s" % this_gps_data)
-        if this_gps_data:
-            _gps_data = self.__get_gps_data()
-            if _gps_data:
-                _gps_data = CRLF.join(_gps_data.split(CRLF)[::-1])
-            _gps_data += this_gps_data.strip().replace("\r", "").replace("\n", "").replace("$", CRLF + "$")
-            _gps_data = CRLF.join(_gps_data.split(CRLF)[::-1])
-            self.__set_gps_data(_gps_data)
+        return self.__assembler.data
+
+    @option_lock(_gps_data_set_lock)
+    def __get_gps_sentences(self):
+        return self.__assembler.sentences
+
+    @property
+    def nmea_rejected(self):
+        """dict: sentence type to count of NMEA sentences dropped by checksum."""
+        with _gps_data_set_lock:
+            return self.__assembler.rejected
 
     def __gps_timer_callback(self, args):
-        self.__break = 1
-        if self.__external_retrieve_queue is not None:
-            self.__external_retrieve_queue.put(False)
+        self.__external_signal(False)
 
     def __gps_data_check_callback(self, args):
         if not self.__check_gps_valid():
             self.__gps_nmea_data_clean()
 
     def __external_init(self):
-        self.__external_retrieve_queue = Queue(maxsize=self.__queue_size)
+        self.__external_buf = bytearray(256)
+        self.__external_view = memoryview(self.__external_buf)
+
+    def __now(self):
+        return utime.mktime(utime.localtime())
+
+    def __gnss_wake(self):
+        """Bring GNSS out of the retention state and decide the start type by the retained data age."""
+        self.__start_type = "cold"
+        if self.__retained and self.__last_fix_time is not None:
+            age = self.__now() - self.__last_fix_time
+            if 0 <= age < self.__HOT_START_AGE:
+                self.__start_type = "hot"
+            elif 0 <= age < self.__WARM_START_AGE:
+                self.__start_type = "warm"
+        if self.__gps_mode == self._gps_mode.external:
+            if self.__gps_sleep_mode == self._gps_sleep_mode.standby:
+                self.standby(0)
+            self.power_switch(1)
+        self.__open_ticks = utime.ticks_ms()
+        log.debug("GNSS %s start." % self.__start_type)
+
+    def __gnss_sleep(self):
+        """Put GNSS into the retention state configured by `gps_sleep_mode`."""
+        if self.__gps_mode == self._gps_mode.external:
+            if self.__gps_sleep_mode == self._gps_sleep_mode.backup:
+                # Keep backup supply on for RTC and ephemeris, then cut main power.
+                self.__retained = self.backup(1) and self.power_switch(0)
+            elif self.__gps_sleep_mode == self._gps_sleep_mode.standby:
+                self.__retained = self.standby(1)
+            elif self.__gps_sleep_mode == self._gps_sleep_mode.pull_off:
+                self.power_switch(0)
+                self.__retained = False
+            else:
+                # Receiver is left powered and keeps tracking.
+                self.__retained = True
+        else:
+            # quecgnss keeps its aiding data while the module is powered.
+            self.__retained = self.__gps_sleep_mode in (self._gps_sleep_mode.backup, self._gps_sleep_mode.standby)
+
+    def __ttff_record(self, success):
+        stat = self.__ttff.setdefault(self.__start_type, {"count": 0, "failed": 0, "last": 0, "total": 0})
+        if success:
+            ttff = utime.ticks_diff(utime.ticks_ms(), self.__open_ticks)
+            stat["count"] += 1
+            stat["last"] = ttff
+            stat["total"] += ttff
+            self.__last_fix_time = self.__now()
+            log.debug("GNSS %s start TTFF %s ms." % (self.__start_type, ttff))
+        else:
+            stat["failed"] += 1
+
+    @property
+    def ttff_stats(self):
+        """Time to first fix by start type.
+
+        Returns:
+            dict: {"cold"/"warm"/"hot": {"count": fix count, "failed": no fix count, "last": ms, "avg": ms}}
+        """
+        return {
+            k: {"count": v["count"], "failed": v["failed"], "last": v["last"], "avg": int(v["total"] / v["count"]) if v["count"] else 0}
+            for k, v in self.__ttff.items()
+        }
 
     def __external_open(self):
-        self.power_switch(1)
+        self.__gnss_wake()
         self.__external_obj = UART(
             self.__UARTn,
             self.__buadrate,
@@ -372,11 +823,38 @@ class GNSS(GNSSPower):
 
     def __external_close(self):
         self.__external_obj.close()
+        self.__gnss_sleep()
+
+    def __external_signal(self, res):
+        """Wake up `__external_read` once, by fix found or read timeout."""
+        if self.__external_reading:
+            self.__external_reading = False
+            self.__external_retrieve_queue.put(res)
+
+    def __external_drain(self):
+        """Read the pending UART bytes, into the preallocated buffer if UART supports `readinto`.
+
+        Returns:
+            memoryview/bytes/None: read data, None if nothing to read.
+        """
+        to_read = self.__external_obj.any()
+        if to_read <= 0:
+            return None
+        if hasattr(self.__external_obj, "readinto"):
+            to_read = self.__external_obj.readinto(self.__external_buf, min(to_read, len(self.__external_buf)))
+            return self.__external_view[:to_read] if to_read else None
+        return self.__external_obj.read(to_read)
 
     def __external_retrieve_cb(self, args):
-        if self.__external_retrieve_queue.size() >= self.__queue_size:
-            self.__external_retrieve_queue.get()
-        self.__external_retrieve_queue.put(True)
+        while True:
+            data = self.__external_drain()
+            if not data:
+                break
+            if self.__feed_gps_data(data):
+                if self.__stream_running:
+                    self.__stream_check()
+                if self.__external_reading and self.__check_gps_valid():
+                    self.__external_signal(True)
 
     def __internal_init(self):
         if self.__internal_obj:
@@ -388,107 +866,104 @@ class GNSS(GNSSPower):
             log.error("Module quecgnss Import Error.")
 
     def __internal_open(self):
+        self.__gnss_wake()
         return True if self.__internal_obj.gnssEnable(1) == 0 else False
 
     def __internal_close(self):
-        return True if self.__internal_obj.gnssEnable(0) == 0 else False
-
-    def __nmea_statement_exist(self, nmea_item):
-        return (self.__NMEA & (0b1 << nmea_item)) >> nmea_item
+        res = True if self.__internal_obj.gnssEnable(0) == 0 else False
+        self.__gnss_sleep()
+        return res
 
     def __gps_nmea_data_clean(self):
-        self.__set_gps_data("")
-        self.__rmc_data = ""
-        self.__gga_data = ""
-        self.__gsv_data = ""
-        self.__gsa_data = ""
-        self.__vtg_data = ""
-        self.__gll_data = ""
+        self.__clear_gps_data()
 
+    @option_lock(_gps_data_check_lock)
     def __check_gps_valid(self):
-        self.__nmea_parse.set_gps_data(self.__get_gps_data())
-        if not self.__rmc_data:
-            self.__rmc_data = self.__nmea_parse.GxRMC
-        _rmc_info = self.__nmea_parse.GxRMCData
-        loc_status = _rmc_info[2] if _rmc_info else "V"
-
-        if self.__rmc_data and loc_status == "A":
-            if self.__nmea_statement_exist(self.__GGA) and not self.__gga_data:
-                self.__gga_data = self.__nmea_parse.GxGGA
-            if self.__nmea_statement_exist(self.__GSV) and not self.__gsv_data:
-                self.__gsv_data = self.__nmea_parse.GxGSV
-            if self.__nmea_statement_exist(self.__GSA) and not self.__gsa_data:
-                self.__gsa_data = self.__nmea_parse.GxGSA
-            if self.__nmea_statement_exist(self.__VTG) and not self.__vtg_data:
-                self.__vtg_data = self.__nmea_parse.GxVTG
-            if self.__nmea_statement_exist(self.__GLL) and not self.__gll_data:
-                self.__gll_data = self.__nmea_parse.GxGLL
-
-            if self.__nmea_statement_exist(self.__GGA) and not self.__gga_data:
-                return False
-            if self.__nmea_statement_exist(self.__GSV) and not self.__gsv_data:
-                return False
-            if self.__nmea_statement_exist(self.__GSA) and not self.__gsa_data:
-                return False
-            if self.__nmea_statement_exist(self.__VTG) and not self.__vtg_data:
-                return False
-            if self.__nmea_statement_exist(self.__GLL) and not self.__gll_data:
-                return False
-            return True
+        self.__nmea_parse.set_sentences(self.__get_gps_sentences())
+        return self.__fix_policy.check(self.__nmea_parse)
 
-        return False
+    @option_lock(_gps_data_set_lock)
+    def __stream_sentences(self):
+        """Get sentences when a new RMC and GGA pair is assembled since the last fix record."""
+        seq = (self.__assembler.seq("RMC"), self.__assembler.seq("GGA"))
+        if seq[0] == self.__stream_seq[0] or seq[1] == self.__stream_seq[1]:
+            return None
+        self.__stream_seq = seq
+        return self.__assembler.sentences
+
+    def __stream_check(self):
+        sentences = self.__stream_sentences()
+        if sentences is None:
+            return
+        self.__stream_parse.set_sentences(sentences)
+        if not self.__fix_policy.check(self.__stream_parse):
+            return
+        fix = self.__stream_parse.fix
+        if fix is None:
+            return
+        self.__stream_count += 1
+        if self.__stream_count < self.__stream_rate:
+            return
+        self.__stream_count = 0
+
+        fix.policy = self.__fix_policy.name
+        if self.__stream_callback:
+            try:
+                self.__stream_callback(fix)
+            except Exception as e:
+                sys.print_exception(e)
+        else:
+            if self.__stream_queue.size() >= self.__queue_size:
+                self.__stream_queue.get()
+            self.__stream_queue.put(fix)
+
+    def __internal_stream_running(self):
+        while self.__stream_running:
+            gnss_data = quecgnss.read(1024)
+            if gnss_data and gnss_data[1] and self.__feed_gps_data(gnss_data[1]):
+                self.__stream_check()
+                if self.__external_reading and self.__check_gps_valid():
+                    self.__external_signal(True)
+            utime.sleep_ms(200)
+
+    def __stream_read(self):
+        """Wait the next valid fix of the running stream, GNSS is kept on."""
+        while self.__external_retrieve_queue.size() > 0:
+            self.__external_retrieve_queue.get()
+        self.__external_reading = True
+        self.__gps_timer.start(self.__retry * 1000, 0, self.__gps_timer_callback)
+        self.__external_retrieve_queue.get()
+        self.__external_reading = False
+        self.__gps_timer.stop()
+        return self.__get_gps_data() if self.__check_gps_valid() else ""
 
     def __external_read(self):
-        self.__external_open()
         log.debug("__external_read start")
-
-        while self.__break == 0:
-            self.__gps_timer.start(50, 0, self.__gps_timer_callback)
-            signal = self.__external_retrieve_queue.get()
-            log.debug("[first] signal: %s" % signal)
-            if signal:
-                to_read = self.__external_obj.any()
-                log.debug("[first] to_read: %s" % to_read)
-                if to_read > 0:
-                    self.__set_gps_data(self.__external_obj.read(to_read).decode())
-            self.__gps_timer.stop()
-        self.__break = 0
-
+        while self.__external_retrieve_queue.size() > 0:
+            self.__external_retrieve_queue.get()
         self.__gps_nmea_data_clean()
+        self.__external_reading = True
+        self.__external_open()
+
+        # UART callback feeds data and checks fix, here only wait for fix or timeout.
         self.__gps_data_check_timer.start(2000, 1, self.__gps_data_check_callback)
-        cycle = 0
-        while self.__break == 0:
-            self.__gps_timer.start(1500, 0, self.__gps_timer_callback)
-            signal = self.__external_retrieve_queue.get()
-            log.debug("[second] signal: %s" % signal)
-            if signal:
-                to_read = self.__external_obj.any()
-                log.debug("[second] to_read: %s" % to_read)
-                if to_read > 0:
-                    self.__reverse_gps_data(self.__external_obj.read(to_read).decode())
-                    if self.__check_gps_valid():
-                        self.__break = 1
-
-            self.__gps_timer.stop()
-            cycle += 1
-            if cycle >= self.__retry:
-                self.__break = 1
-            if self.__break != 1:
-                utime.sleep(1)
+        self.__gps_timer.start(self.__retry * 1000, 0, self.__gps_timer_callback)
+        self.__external_retrieve_queue.get()
+        self.__external_reading = False
+        self.__gps_timer.stop()
         self.__gps_data_check_timer.stop()
-        self.__break = 0
+        self.__external_close()
 
         # To check GPS data is usable or not.
         self.__gps_data_check_callback(None)
-        self.__external_close()
-        log.debug("__external_read %s." % ("success" if self.__get_gps_data() else "failed"))
+        log.debug("__external_read %s, fix policy %s." % ("success" if self.__get_gps_data() else "failed", self.__fix_policy.name))
         return self.__get_gps_data()
 
     def __internal_read(self):
         log.debug("__internal_read start.")
         self.__internal_open()
 
-        while self.__break == 0:
+        while self.__break == 0 and self.__cancel == 0:
             gnss_data = quecgnss.read(1024)
             if gnss_data[0] == 0:
                 self.__break = 1
@@ -497,56 +972,405 @@ class GNSS(GNSSPower):
         self.__gps_nmea_data_clean()
         self.__gps_data_check_timer.start(2000, 1, self.__gps_data_check_callback)
         cycle = 0
-        while self.__break == 0:
+        while self.__break == 0 and self.__cancel == 0:
             gnss_data = quecgnss.read(1024)
             if gnss_data and gnss_data[1]:
-                this_gps_data = gnss_data[1].decode() if len(gnss_data) > 1 and gnss_data[1] else ""
-                self.__reverse_gps_data(this_gps_data)
+                self.__feed_gps_data(gnss_data[1])
                 if self.__check_gps_valid():
                     self.__break = 1
             cycle += 1
             if cycle >= self.__retry:
                 if self.__break != 1:
                     self.__break = 1
-            if self.__break != 1:
+            if self.__break != 1 and self.__cancel == 0:
                 utime.sleep(1)
         self.__gps_data_check_timer.stop()
         self.__break = 0
 
         self.__gps_data_check_callback(None)
         self.__internal_close()
-        log.debug("__internal_read %s." % ("success" if self.__get_gps_data() else "failed"))
+        log.debug("__internal_read %s, fix policy %s." % ("success" if self.__get_gps_data() else "failed", self.__fix_policy.name))
         return self.__get_gps_data()
 
+    def start_stream(self, callback=None, rate=1):
+        """Keep GNSS running and deliver fix records as they arrive.
+
+        A `Fix` record is made from every RMC and GGA pair accepted by the fix policy.
+
+        Args:
+            callback (function): called with every `rate`th `Fix`, if None,
+                the records are queued for `fixes`. (default: `None`)
+            rate (int): decimation rate, deliver one of every `rate` fix records. (default: `1`)
+
+        Returns:
+            bool: True - success, False - failed.
+        """
+        if self.__stream_running:
+            return False
+        self.__stream_callback = callback
+        self.__stream_rate = rate if isinstance(rate, int) and rate > 0 else 1
+        self.__stream_count = 0
+        self.__stream_queue = Queue(maxsize=self.__queue_size) if callback is None else None
+        self.__gps_nmea_data_clean()
+        self.__stream_running = True
+        if self.__gps_mode == self._gps_mode.external:
+            self.__external_open()
+        elif self.__gps_mode == self._gps_mode.internal and self.__internal_open():
+            _thread.stack_size(0x1000)
+            _thread.start_new_thread(self.__internal_stream_running, ())
+        else:
+            self.__stream_running = False
+        return self.__stream_running
+
+    def stop_stream(self):
+        """Stop continuous mode and turn GNSS off.
+
+        Returns:
+            bool: True - success, False - stream is not running.
+        """
+        if not self.__stream_running:
+            return False
+        self.__stream_running = False
+        if self.__gps_mode == self._gps_mode.external:
+            self.__external_close()
+        elif self.__gps_mode == self._gps_mode.internal:
+            self.__internal_close()
+        if self.__stream_queue is not None:
+            self.__stream_queue.put(None)
+        return True
+
+    def fixes(self, rate=1):
+        """Generator of fix records, start continuous mode when it is not running.
+
+        Iteration ends after `stop_stream` is called.
+
+        Args:
+            rate (int): decimation rate, used when this call starts the stream. (default: `1`)
+
+        Yields:
+            Fix: fix record.
+        """
+        if not self.__stream_running:
+            self.start_stream(rate=rate)
+        while self.__stream_running and self.__stream_queue is not None:
+            fix = self.__stream_queue.get()
+            if fix is None:
+                break
+            yield fix
+
+    def set_fix_policy(self, policy):
+        """Set the fix acceptance policy.
+
+        Args:
+            policy (GNSSFixPolicy): policy object.
+
+        Returns:
+            bool: True - success, False - failed.
+        """
+        if isinstance(policy, GNSSFixPolicy):
+            self.__fix_policy = policy
+            return True
+        return False
+
+    @property
+    def fix_policy(self):
+        """str: name of the fix acceptance policy, reported with each fix."""
+        return self.__fix_policy.name
+
+    def cancel(self):
+        """Stop a running `read` as timeout, used when another location source has won."""
+        if self.__gps_mode == self._gps_mode.internal:
+            self.__cancel = 1
+        self.__external_signal(False)
+
+    @property
+    def streaming(self):
+        return self.__stream_running
+
     def read(self, retry=30):
+        """Open GNSS, wait a valid fix and close GNSS.
+
+        Args:
+            retry (int): max wait seconds for a valid fix. (default: `30`)
+
+        Returns:
+            tuple: (0 - success / -1 - failed, NMEA data)
+        """
         self.__retry = retry
         gps_data = ""
-        if self.__gps_mode == self._gps_mode.external:
+        if self.__stream_running:
+            gps_data = self.__stream_read()
+        elif self.__gps_mode == self._gps_mode.external:
             gps_data = self.__external_read()
+            self.__ttff_record(bool(gps_data))
         elif self.__gps_mode == self._gps_mode.internal:
             gps_data = self.__internal_read()
+            self.__cancel = 0
+            self.__ttff_record(bool(gps_data))
 
         res = 0 if gps_data else -1
         return (res, gps_data)
 
 
+def serving_cell():
+    """Read serving cell identity.
+
+    Returns:
+        tuple/None: (mcc, mnc, lac, cid), None if not registered.
+    """
+    try:
+        cell = (net.getServingMcc(), net.getServingMnc(), net.getServingLac(), net.getServingCi())
+        if -1 not in cell:
+            return cell
+    except Exception as e:
+        sys.print_exception(e)
+    return None
+
+
+class CellLocCache:
+    """This class is for caching CellLocator results by serving cell.
+
+    Entries expire after `ttl` seconds, the least recently used entry is evicted
+    when the cache is full, and the cache is saved to flash when it changes.
+    """
+
+    def __init__(self, cache_file="/usr/cell_loc_cache.json", ttl=7 * 24 * 3600, max_size=64):
+        """
+        Parameter:
+            cache_file: filename include full path
+            ttl: entry time to live, unit: second
+            max_size: max count of cached cells
+        """
+        self.__file = cache_file
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__lock = _thread.allocate_lock()
+        # key: "mcc-mnc-lac-cid", value: [longitude, latitude, accuracy, saved time, used time]
+        self.__cache = {}
+        self.__load()
+
+    def __now(self):
+        return utime.mktime(utime.localtime())
+
+    def __key(self, cell):
+        return "%s-%s-%s-%s" % tuple(cell)
+
+    def __load(self):
+        try:
+            if ql_fs.path_exists(self.__file):
+                cache = ql_fs.read_json(self.__file)
+                if isinstance(cache, dict):
+                    self.__cache = cache
+        except Exception as e:
+            sys.print_exception(e)
+
+    def __save(self):
+        return ql_fs.touch(self.__file, self.__cache) == 0
+
+    def get(self, cell):
+        """Get cached location of the cell.
+
+        Args:
+            cell (tuple): (mcc, mnc, lac, cid)
+
+        Returns:
+            tuple: (longitude, latitude, accuracy), empty if not cached or expired.
+        """
+        key = self.__key(cell)
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is None:
+                return ()
+            now = self.__now()
+            if not 0 <= now - entry[3] < self.__ttl:
+                self.__cache.pop(key)
+                self.__save()
+                return ()
+            entry[4] = now
+            return tuple(entry[:3])
+
+    def put(self, cell, loc_data):
+        """Cache location of the cell.
+
+        Args:
+            cell (tuple): (mcc, mnc, lac, cid)
+            loc_data (tuple): (longitude, latitude, accuracy)
+
+        Returns:
+            bool: True - success, False - failed.
+        """
+        now = self.__now()
+        with self.__lock:
+            self.__cache[self.__key(cell)] = [loc_data[0], loc_data[1], loc_data[2] if len(loc_data) > 2 else 0, now, now]
+            while len(self.__cache) > self.__max_size:
+                lru = min(self.__cache.keys(), key=lambda k: self.__cache[k][4])
+                self.__cache.pop(lru)
+            return self.__save()
+
+    def clean(self):
+        with self.__lock:
+            self.__cache = {}
+            return self.__save()
+
+
+class CellTowerDB:
+    """This class is for offline cell tower geolocation.
+
+    The database is a sorted fixed width binary file, so a lookup is a binary
+    search over file offsets and uses O(1) RAM.
+
+    File format, big endian:
+        header: b"CTDB", version (u16), record size (u16), record count (u32)
+        record: mcc (u16), mnc (u16), lac (u32), cid (u32), latitude (i32, 1e-7 degree), longitude (i32, 1e-7 degree)
+    Records are sorted by the 12 bytes key (mcc, mnc, lac, cid).
+    """
+
+    MAGIC = b"CTDB"
+    VERSION = 1
+    __HEADER_FMT = ">4sHHI"
+    __KEY_FMT = ">HHII"
+    __RECORD_FMT = ">HHIIii"
+    __HEADER_SIZE = ustruct.calcsize(__HEADER_FMT)
+    __KEY_SIZE = ustruct.calcsize(__KEY_FMT)
+    __RECORD_SIZE = ustruct.calcsize(__RECORD_FMT)
+
+    # CSV header names of each column, operator export or OpenCellID.
+    __COLUMNS = {
+        "mcc": ("mcc",),
+        "mnc": ("mnc", "net"),
+        "lac": ("lac", "tac", "area"),
+        "cid": ("cid", "ci", "cell"),
+        "lat": ("lat", "latitude"),
+        "lon": ("lon", "lng", "longitude"),
+    }
+
+    def __init__(self, db_file="/usr/cell_tower.db"):
+        """
+        Parameter:
+            db_file: filename include full path
+        """
+        self.__file = db_file
+        self.__count = 0
+        self.__lock = _thread.allocate_lock()
+        self.__load()
+
+    def __load(self):
+        self.__count = 0
+        try:
+            if ql_fs.path_exists(self.__file):
+                with open(self.__file, "rb") as f:
+                    magic, version, size, count = ustruct.unpack(self.__HEADER_FMT, f.read(self.__HEADER_SIZE))
+                if magic == self.MAGIC and version == self.VERSION and size == self.__RECORD_SIZE:
+                    self.__count = count
+                else:
+                    log.error("CellTowerDB %s format error." % self.__file)
+        except Exception as e:
+            sys.print_exception(e)
+
+    @property
+    def count(self):
+        return self.__count
+
+    def lookup(self, cell):
+        """Binary search the cell location.
+
+        Args:
+            cell (tuple): (mcc, mnc, lac, cid)
+
+        Returns:
+            tuple: (longitude, latitude, 0), empty if not found.
+        """
+        if not self.__count:
+            return ()
+        key = ustruct.pack(self.__KEY_FMT, *cell)
+        with self.__lock:
+            try:
+                with open(self.__file, "rb") as f:
+                    low = 0
+                    high = self.__count - 1
+                    while low <= high:
+                        mid = (low + high) // 2
+                        f.seek(self.__HEADER_SIZE + mid * self.__RECORD_SIZE)
+                        record = f.read(self.__RECORD_SIZE)
+                        _key = record[:self.__KEY_SIZE]
+                        if _key == key:
+                            lat, lon = ustruct.unpack(">ii", record[self.__KEY_SIZE:])
+                            return (lon / 10000000, lat / 10000000, 0)
+                        elif _key < key:
+                            low = mid + 1
+                        else:
+                            high = mid - 1
+            except Exception as e:
+                sys.print_exception(e)
+        return ()
+
+    def import_csv(self, csv_file):
+        """Build the database from a CSV file with a header line.
+
+        Columns are found by header name, operator exports (mcc, mnc, lac, cid, lat, lon)
+        and OpenCellID exports (mcc, net, area, cell, lon, lat) are supported.
+        Records are sorted in RAM, a large table should be built off device.
+
+        Args:
+            csv_file (str): CSV filename include full path.
+
+        Returns:
+            int: count of imported records, -1 if failed.
+        """
+        records = {}
+        try:
+            with open(csv_file, "r") as f:
+                header = [i.strip().lower() for i in f.readline().split(",")]
+                index = {}
+                for k, names in self.__COLUMNS.items():
+                    for name in names:
+                        if name in header:
+                            index[k] = header.index(name)
+                            break
+                    else:
+                        log.error("CellTowerDB CSV has no %s column." % k)
+                        return -1
+                for line in f:
+                    row = line.split(",")
+                    try:
+                        record = ustruct.pack(
+                            self.__RECORD_FMT,
+                            int(row[index["mcc"]]), int(row[index["mnc"]]), int(row[index["lac"]]), int(row[index["cid"]]),
+                            int(round(float(row[index["lat"]]) * 10000000)), int(round(float(row[index["lon"]]) * 10000000)),
+                        )
+                    except (IndexError, ValueError, OverflowError):
+                        continue
+                    records[record[:self.__KEY_SIZE]] = record
+            tmp_file = self.__file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                f.write(ustruct.pack(self.__HEADER_FMT, self.MAGIC, self.VERSION, self.__RECORD_SIZE, len(records)))
+                for key in sorted(records.keys()):
+                    f.write(records[key])
+            with self.__lock:
+                if ql_fs.path_exists(self.__file):
+                    uos.remove(self.__file)
+                uos.rename(tmp_file, self.__file)
+                self.__load()
+            return self.__count
+        except Exception as e:
+            sys.print_exception(e)
+            return -1
+
+
 class CellLocator:
     """This class is for reading cell location data"""
 
-    def __init__(self, serverAddr, port, token, timeout, profileIdx):
+    def __init__(self, serverAddr, port, token, timeout, profileIdx, cache=None, db=None, pool=None):
+        self.__cache = cache
+        self.__db = db
+        self.__pool = pool if pool else ThreadPool(1)
         self.__serverAddr = serverAddr
         self.__port = port
         self.__token = token
         self.__timeout = timeout
         self.__profileIdx = profileIdx
-        self.__queue = Queue()
-        self.__thread_id = None
-        self.__timeout_timer = osTimer()
 
-    def __timeout_callback(self, args):
-        self.__queue.put(())
-
-    def __read_thread(self):
+    def __read_location(self):
         loc_data = ()
         try:
             loc_data = cellLocator.getLocation(
@@ -559,56 +1383,368 @@ class CellLocator:
             loc_data = loc_data if isinstance(loc_data, tuple) and loc_data[0] and loc_data[1] else ()
         except Exception as e:
             sys.print_exception(e)
-        self.__queue.put(loc_data)
+        return loc_data
 
     def read(self, timeout=5):
         log.debug("CellLocator start read")
-        # Start read thread and stop timeout
-        self.__thread_id = _thread.start_new_thread(self.__read_thread, ())
-        self.__timeout_timer.start(timeout * 1000, 0, self.__timeout_callback)
-        # Wait loc data
-        loc_data = self.__queue.get()
-        # Stop read thread and stop timeout
-        self.__timeout_timer.stop()
-        if _thread.threadIsRunning(self.__thread_id):
-            _thread.stop_thread(self.__thread_id)
-            self.__thread_id = None
+        cell = serving_cell() if self.__cache or self.__db else None
+        if cell and self.__cache:
+            loc_data = self.__cache.get(cell)
+            if loc_data:
+                log.debug("CellLocator cache hit %s" % str(cell))
+                return loc_data
+        if cell and self.__db:
+            loc_data = self.__db.lookup(cell)
+            if loc_data:
+                log.debug("CellLocator tower database hit %s" % str(cell))
+                return loc_data
+        # Run read in pool and drop the result if it is later than timeout.
+        future = self.__pool.submit(self.__read_location)
+        loc_data = future.result(timeout, ())
+        future.cancel()
+        if cell and loc_data and self.__cache:
+            self.__cache.put(cell, loc_data)
         log.debug("CellLocator end read")
         return loc_data
 
 
+class WiFiFingerprintCache:
+    """This class is for answering Wi-Fi location locally.
+
+    A fingerprint (the strongest visible BSSIDs and their RSSI) is learned with
+    the position of every good GNSS fix, a Wi-Fi lookup is answered by the
+    weighted match against the learned fingerprints. The store is capped by
+    `max_size` fingerprints with least recently used eviction.
+
+    File format, a JSON list of fingerprints:
+        [[longitude, latitude, used time, ["bssid", ...], [rssi, ...]], ...]
+    BSSIDs are saved as 12 lower case hex digits.
+    """
+
+    def __init__(self, cache_file="/usr/wifi_fingerprint.json", max_size=128, max_bssid=6, min_score=0.5, min_move=20):
+        """
+        Parameter:
+            cache_file: filename include full path
+            max_size: max count of fingerprints
+            max_bssid: max count of BSSIDs saved in one fingerprint
+            min_score: min match score [0, 1] to answer a lookup
+            min_move: a matched fingerprint with the same BSSIDs is not saved again unless
+                      the position moves more than it, unit: m
+        """
+        self.__file = cache_file
+        self.__max_size = max_size
+        self.__max_bssid = max_bssid
+        self.__min_score = min_score
+        self.__min_move = min_move
+        self.__lock = _thread.allocate_lock()
+        self.__fingerprints = []
+        self.__load()
+
+    def __load(self):
+        try:
+            if ql_fs.path_exists(self.__file):
+                fingerprints = ql_fs.read_json(self.__file)
+                if isinstance(fingerprints, list):
+                    self.__fingerprints = fingerprints
+        except Exception as e:
+            sys.print_exception(e)
+
+    def __save(self):
+        return ql_fs.touch(self.__file, self.__fingerprints) == 0
+
+    def __weight(self, rssi):
+        # -100 dBm and weaker count as 1.
+        return max(1, 100 + rssi)
+
+    def __score(self, aps, fingerprint):
+        """Weighted Jaccard similarity of the scanned APs and a fingerprint."""
+        fp_aps = dict(zip(fingerprint[3], fingerprint[4]))
+        common = 0
+        union = 0
+        for bssid, rssi in aps.items():
+            w = self.__weight(rssi)
+            if bssid in fp_aps:
+                fw = self.__weight(fp_aps.pop(bssid))
+                common += min(w, fw)
+                union += max(w, fw)
+            else:
+                union += w
+        for rssi in fp_aps.values():
+            union += self.__weight(rssi)
+        return common / union if union else 0
+
+    def __strongest(self, aps):
+        return sorted(aps.items(), key=lambda i: i[1], reverse=True)[:self.__max_bssid]
+
+    def scan(self):
+        """Scan visible access points.
+
+        Returns:
+            dict: BSSID to RSSI, empty if wifiScan is not supported or failed.
+        """
+        aps = {}
+        if wifiScan is None:
+            return aps
+        try:
+            if not wifiScan.getState():
+                wifiScan.control(1)
+            res = wifiScan.start()
+            if isinstance(res, tuple) and res[0] > 0:
+                for mac, rssi in res[1]:
+                    aps[mac.replace(":", "").lower()] = rssi
+        except Exception as e:
+            sys.print_exception(e)
+        return aps
+
+    def learn(self, lon, lat, aps):
+        """Save the fingerprint of a position.
+
+        A fingerprint matching the same APs is replaced instead of added,
+        the file is not rewritten if it has the same BSSIDs and nearly the same position.
+
+        Args:
+            lon (float): longitude.
+            lat (float): latitude.
+            aps (dict): BSSID to RSSI.
+
+        Returns:
+            bool: True - success, False - failed.
+        """
+        if not aps:
+            return False
+        strongest = self.__strongest(aps)
+        fingerprint = [lon, lat, utime.mktime(utime.localtime()), [i[0] for i in strongest], [i[1] for i in strongest]]
+        with self.__lock:
+            for i, item in enumerate(self.__fingerprints):
+                if self.__score(dict(strongest), item) >= 0.8:
+                    if set(item[3]) == set(fingerprint[3]) and _distance(item[0], item[1], lon, lat) <= self.__min_move:
+                        # Used time is kept in RAM and saved with the next change.
+                        item[2] = fingerprint[2]
+                        return True
+                    self.__fingerprints[i] = fingerprint
+                    break
+            else:
+                self.__fingerprints.append(fingerprint)
+                if len(self.__fingerprints) > self.__max_size:
+                    lru = min(range(len(self.__fingerprints)), key=lambda i: self.__fingerprints[i][2])
+                    self.__fingerprints.pop(lru)
+            return self.__save()
+
+    def lookup(self, aps):
+        """Locate by the scanned APs.
+
+        Args:
+            aps (dict): BSSID to RSSI.
+
+        Returns:
+            tuple: (longitude, latitude, 0), empty if no fingerprint matches.
+        """
+        if not aps:
+            return ()
+        aps = dict(self.__strongest(aps))
+        with self.__lock:
+            lon = lat = total = 0
+            for item in self.__fingerprints:
+                score = self.__score(aps, item)
+                if score >= self.__min_score:
+                    lon += item[0] * score
+                    lat += item[1] * score
+                    total += score
+                    item[2] = utime.mktime(utime.localtime())
+            return (lon / total, lat / total, 0) if total else ()
+
+    def clean(self):
+        with self.__lock:
+            self.__fingerprints = []
+            return self.__save()
+
+
 class WiFiLocator:
     """This class is for reading wifi location data"""
 
-    def __init__(self, token):
+    def __init__(self, token, cache=None, pool=None, learn_pool=None, learn_interval=600, learn_distance=100):
+        """
+        Parameter:
+            token: wifilocator token
+            cache: `WiFiFingerprintCache` object, None for no local answer and learning
+            pool: `ThreadPool` of reads
+            learn_pool: `ThreadPool` of learning, default its own one worker pool
+            learn_interval: min seconds between two learns at the same place
+            learn_distance: a fix farther than it from the last learned position is learned
+                            before `learn_interval`, unit: m
+        """
+        self.__cache = cache
+        self.__pool = pool if pool else ThreadPool(1)
+        # Fingerprint scans run in their own pool, so learning never takes a read worker.
+        self.__learn_pool = learn_pool if learn_pool else ThreadPool(1)
+        self.__learn_interval = learn_interval
+        self.__learn_distance = learn_distance
+        self.__last_learn = None
         self.__wifilocator_obj = wifilocator(token)
-        self.__queue = Queue()
-        self.__thread_id = None
-        self.__timeout_timer = osTimer()
-
-    def __timeout_callback(self, args):
-        self.__queue.put(())
 
-    def __read_thread(self):
+    def __read_location(self):
         loc_data = ()
         try:
             loc_data = self.__wifilocator_obj.getwifilocator()
             loc_data = loc_data if isinstance(loc_data, tuple) and loc_data[0] and loc_data[1] else ()
         except Exception as e:
             sys.print_exception(e)
-        self.__queue.put(loc_data)
+        return loc_data
+
+    def __learn(self, lon, lat):
+        try:
+            self.__cache.learn(lon, lat, self.__cache.scan())
+        except Exception as e:
+            sys.print_exception(e)
+
+    def learn(self, fix, max_hdop=2.0):
+        """Learn the Wi-Fi fingerprint of a good GNSS fix in the learning pool.
+
+        Args:
+            fix (Fix): GNSS fix, WGS84.
+            max_hdop (float): fix HDOP must be no more than it. (default: `2.0`)
+
+        Learning is rate limited by `learn_interval` unless the fix moves over `learn_distance`
+        from the last learned position, every learn costs a Wi-Fi scan.
+
+        Returns:
+            bool: True - learning started, False - no cache, fix not good or rate limited.
+        """
+        if not self.__cache or fix.source != "gnss" or (fix.hdop is not None and fix.hdop > max_hdop):
+            return False
+        now = utime.mktime(utime.localtime())
+        if self.__last_learn is not None:
+            lon, lat, _time = self.__last_learn
+            if 0 <= now - _time < self.__learn_interval and _distance(lon, lat, fix.lon, fix.lat) <= self.__learn_distance:
+                return False
+        self.__last_learn = (fix.lon, fix.lat, now)
+        self.__learn_pool.submit(self.__learn, fix.lon, fix.lat)
+        return True
 
     def read(self, timeout=5):
         log.debug("WiFiLocator start read")
-        # Start read thread and stop timeout
-        self.__thread_id = _thread.start_new_thread(self.__read_thread, ())
-        self.__timeout_timer.start(timeout * 1000, 0, self.__timeout_callback)
-        # Wait loc data
-        loc_data = self.__queue.get()
-        # Stop read thread and stop timeout
-        self.__timeout_timer.stop()
-        if _thread.threadIsRunning(self.__thread_id):
-            _thread.stop_thread(self.__thread_id)
-            self.__thread_id = None
+        if self.__cache:
+            loc_data = self.__cache.lookup(self.__cache.scan())
+            if loc_data:
+                log.debug("WiFiLocator fingerprint hit")
+                return loc_data
+        # Run read in pool and drop the result if it is later than timeout.
+        future = self.__pool.submit(self.__read_location)
+        loc_data = future.result(timeout, ())
+        future.cancel()
         log.debug("WiFiLocator end read")
         return loc_data
+
+
+class LocationRace:
+    """This class is for racing GNSS, CellLocator and WiFiLocator.
+
+    The enabled sources are read at the same time, the first GNSS fix wins at once,
+    otherwise the best network fix (Wi-Fi before cell) wins after `network_wait`
+    seconds or when every source has returned. The losing GNSS read is cancelled,
+    late network results are dropped.
+    """
+
+    __NETWORK_RANK = {"cell": 1, "wifi": 2}
+
+    def __init__(self, gnss=None, cell=None, wifi=None, nmea_parse=None, pool=None):
+        self.__pool = pool if pool else ThreadPool(3)
+        self.__gnss = gnss
+        self.__cell = cell
+        self.__wifi = wifi
+        self.__nmea_parse = nmea_parse if nmea_parse else NMEAParse()
+        self.__queue = Queue()
+        self.__race_id = 0
+        self.__timer = osTimer()
+        self.__winner = None
+
+    def __read_gnss(self, timeout):
+        res = self.__gnss.read(timeout)
+        if res[0] != 0:
+            return None
+        self.__nmea_parse.set_gps_data(res[1])
+        fix = self.__nmea_parse.fix
+        if fix is not None:
+            fix.policy = self.__gnss.fix_policy
+        return fix
+
+    def __read_cell(self):
+        res = self.__cell.read()
+        return Fix(lon=res[0], lat=res[1], source="cell") if res else None
+
+    def __read_wifi(self):
+        res = self.__wifi.read()
+        return Fix(lon=res[0], lat=res[1], source="wifi") if res else None
+
+    def __run(self, race_id, source, func, args):
+        fix = None
+        try:
+            fix = func(*args)
+        except Exception as e:
+            sys.print_exception(e)
+        self.__queue.put((race_id, source, fix))
+
+    def __start(self, race_id, source, func, args=()):
+        self.__pool.submit(self.__run, race_id, source, func, args)
+
+    def read(self, gps=True, cell=True, wifi=True, gps_timeout=300, network_wait=30):
+        """Race the enabled location sources.
+
+        Args:
+            gps (bool): read GNSS. (default: `True`)
+            cell (bool): read CellLocator. (default: `True`)
+            wifi (bool): read WiFiLocator. (default: `True`)
+            gps_timeout (int): GNSS read timeout, unit: second. (default: `300`)
+            network_wait (int): seconds to wait GNSS before a network fix is accepted. (default: `30`)
+
+        Returns:
+            Fix/None: the winner fix, `Fix.source` is the winner source.
+        """
+        self.__race_id += 1
+        race_id = self.__race_id
+        pending = []
+        if gps and self.__gnss:
+            pending.append("gnss")
+            self.__start(race_id, "gnss", self.__read_gnss, (gps_timeout,))
+        if cell and self.__cell:
+            pending.append("cell")
+            self.__start(race_id, "cell", self.__read_cell)
+        if wifi and self.__wifi:
+            pending.append("wifi")
+            self.__start(race_id, "wifi", self.__read_wifi)
+        if "gnss" in pending and len(pending) > 1:
+            self.__timer.start(network_wait * 1000, 0, lambda args: self.__queue.put((race_id, "timer", None)))
+
+        best = None
+        budget_over = False
+        while pending:
+            _race_id, source, fix = self.__queue.get()
+            if _race_id != race_id:
+                continue
+            if source == "timer":
+                budget_over = True
+            else:
+                pending.remove(source)
+                if fix is not None:
+                    if source == "gnss":
+                        best = fix
+                        break
+                    if best is None or self.__NETWORK_RANK[source] > self.__NETWORK_RANK[best.source]:
+                        best = fix
+            if best is not None and budget_over:
+                break
+        self.__timer.stop()
+        if "gnss" in pending:
+            self.__gnss.cancel()
+
+        self.__winner = best.source if best else None
+        log.debug("LocationRace winner: %s, cancelled: %s" % (self.__winner, pending))
+        # Learn only when Wi-Fi location is enabled, a fingerprint scan costs power.
+        if self.__winner == "gnss" and wifi and self.__wifi:
+            self.__wifi.learn(best)
+        return best
+
+    @property
+    def winner(self):
+        """str/None: source of the last race winner."""
+        return self.__winner
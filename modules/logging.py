@@ -41,6 +41,8 @@ import ql_fs
 import _thread
 import usys as sys
 
+from usr.modules.common import atomic_touch, atomic_read_json
+
 _LOG_LOCK = _thread.allocate_lock()
 _LOG_LEVEL_CODE = {
     "debug": 0,
@@ -59,6 +61,39 @@ _log_size = 0x2000
 _log_back = 8
 _log_level = "debug"
 _log_debug = True
+# Log segment generation and estimated write count of each segment, loaded from meta file at first save.
+_log_gen = None
+_log_writes = []
+# Meta file is saved every `_log_meta_step` writes, counts not saved yet are lost by reboot.
+_log_meta_step = 16
+_log_unsaved = 0
+
+
+def _log_segment(gen):
+    return _log_file + "." + str(gen % (_log_back + 1))
+
+
+def _log_meta_load():
+    """Load generation and write counts, move a log file without segment into its segment."""
+    global _log_gen, _log_writes, _log_unsaved
+    meta = atomic_read_json(_log_file + ".meta")
+    if not isinstance(meta, dict):
+        meta = {}
+    _log_gen = meta.get("gen", 0)
+    _log_writes = (meta.get("writes", []) + [0] * (_log_back + 1))[:_log_back + 1]
+    _log_unsaved = 0
+    # Log file of the rename rotation, its backups `.1` ~ `.n` are kept as older segments.
+    if ql_fs.path_exists(_log_file):
+        if ql_fs.path_exists(_log_segment(_log_gen)):
+            uos.remove(_log_file)
+        else:
+            uos.rename(_log_file, _log_segment(_log_gen))
+
+
+def _log_meta_save():
+    global _log_unsaved
+    _log_unsaved = 0
+    atomic_touch(_log_file + ".meta", {"gen": _log_gen, "writes": _log_writes})
 
 
 class Logger:
@@ -69,27 +104,32 @@ class Logger:
     def __save_log(self, msg):
         """Save log message to local file.
 
+        Log is written to segment `_log_file + "." + str(gen % (_log_back + 1))`,
+        when the segment is full the next generation overwrites the oldest segment,
+        so no file is renamed and erase cycles are spread over the segments.
+
         Args:
             msg (str): log message.
         """
-        global _log_path, _log_file
+        global _log_gen, _log_unsaved
         try:
-            log_size = 0
             if not ql_fs.path_exists(_log_path):
                 uos.mkdir(_log_path[:-1])
-            if ql_fs.path_exists(_log_file):
-                log_size = ql_fs.path_getsize(_log_file)
-                if log_size + len(msg) >= _log_size:
-                    for i in range(_log_back, 0, -1):
-                        bak_file = _log_file + "." + str(i)
-                        if ql_fs.path_exists(bak_file):
-                            if i == _log_back:
-                                uos.remove(bak_file)
-                            else:
-                                uos.rename(bak_file, _log_file + "." + str(i + 1))
-                    uos.rename(_log_file, _log_file + ".1")
-            with open(_log_file, "a") as lf:
+            if _log_gen is None:
+                _log_meta_load()
+            mode = "a"
+            log_file = _log_segment(_log_gen)
+            if ql_fs.path_exists(log_file) and ql_fs.path_getsize(log_file) + len(msg) >= _log_size:
+                _log_gen += 1
+                log_file = _log_segment(_log_gen)
+                mode = "w"
+                _log_meta_save()
+            with open(log_file, mode) as lf:
                 lf.write(msg)
+            _log_writes[_log_gen % (_log_back + 1)] += 1
+            _log_unsaved += 1
+            if _log_unsaved >= _log_meta_step:
+                _log_meta_save()
         except Exception as e:
             sys.print_exception(e)
 
@@ -180,8 +220,8 @@ def setLogSave(save, path, name, size=None, backups=None):
         save (bool): True - save log to file, False - not save log to file.
         path (str): Log file path.
         name (str): Log file name.
-        size (int): Log file max size. (default: `None`)
-        backups (int): Log file max backup count. (default: `None`)
+        size (int): Log segment file max size. (default: `None`)
+        backups (int): Log segment file count is `backups + 1`. (default: `None`)
 
     Returns:
         tuple: set result.
@@ -194,12 +234,14 @@ def setLogSave(save, path, name, size=None, backups=None):
             result message:
                 error message.
     """
-    global _log_save, _log_path, _log_name, _log_file, _log_size, _log_back
+    global _log_save, _log_path, _log_name, _log_file, _log_size, _log_back, _log_gen
     if not path.endswith("/"):
         path += "/"
     _log_path = path
     _log_name = name
     _log_file = _log_path + _log_name
+    # Reload segments of the new log file.
+    _log_gen = None
 
     if not isinstance(save, bool):
         return (1, "save is not bool.")
@@ -214,6 +256,26 @@ def setLogSave(save, path, name, size=None, backups=None):
     return (0, "success.")
 
 
+def getLogDiagnostics():
+    """Get log segments diagnostics.
+
+    Returns:
+        dict: {
+            "gen": current generation,
+            "segments": [{"file": filename, "writes": estimated write count, "size": file size}, ...]
+        }
+    """
+    with _LOG_LOCK:
+        if _log_gen is None:
+            _log_meta_load()
+        segments = []
+        for i in range(_log_back + 1):
+            log_file = _log_file + "." + str(i)
+            size = ql_fs.path_getsize(log_file) if ql_fs.path_exists(log_file) else 0
+            segments.append({"file": log_file, "writes": _log_writes[i], "size": size})
+        return {"gen": _log_gen, "segments": segments}
+
+
 def setLogLevel(level):
     """Set project log level.
 
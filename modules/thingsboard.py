@@ -136,6 +136,43 @@ class TBDeviceMQTTClient:
             usys.print_exception(e)
         return False
 
+    def send_telemetry_batch(self, samples, max_size=4096):
+        """Send timestamped telemetry in `[{"ts": ts, "values": {...}}, ...]` messages.
+
+        Samples are chunked into messages not over `max_size`, a sample over it is sent alone.
+
+        Args:
+            samples (list): [{"ts": millisecond timestamp, "values": {key: value}}, ...]
+            max_size (int): max message size, unit: byte.
+
+        Returns:
+            int: count of sent samples from the head.
+        """
+        count = 0
+        chunk = []
+        size = 2
+        for sample in samples:
+            item = ujson.dumps(sample)
+            if chunk and size + len(item) + 1 > max_size:
+                if not self.send_telemetry_raw("[" + ",".join(chunk) + "]"):
+                    return count
+                count += len(chunk)
+                chunk = []
+                size = 2
+            chunk.append(item)
+            size += len(item) + 1
+        if chunk and self.send_telemetry_raw("[" + ",".join(chunk) + "]"):
+            count += len(chunk)
+        return count
+
+    def send_telemetry_raw(self, data):
+        try:
+            self.__mqtt.publish(TELEMETRY_TOPIC, data, qos=self.__qos)
+            return True
+        except Exception as e:
+            usys.print_exception(e)
+        return False
+
     def send_rpc_reply(self, data, request_id):
         try:
             self.__mqtt.publish(RPC_RESPONSE_TOPIC + request_id, ujson.dumps(data), qos=self.__qos)
@@ -36,11 +36,12 @@
 """
 
 import uos
-import ql_fs
+import ujson
 import modem
 import _thread
 import usys as sys
 
+from usr.modules.common import atomic_touch, atomic_read_json
 try:
     from usr.dev_settings_server import AliIotConfig, ThingsBoardConfig
 except ImportError:
@@ -60,17 +61,96 @@ FIRMWARE_NAME = uos.uname()[0].split("=")[1]
 FIRMWARE_VERSION = modem.getDevFwVersion()
 
 
+class SettingsSnapshot:
+    """Read-only view of settings, values can be got by attribute or by key.
+
+    Nested dicts are snapshots too and lists are tuples, so a snapshot can be
+    shared between threads without locking. Use `to_dict` to get a mutable copy.
+    """
+
+    def __init__(self, data, version=0):
+        """
+        Parameter:
+            data: settings dict, it is copied, not referenced.
+            version: settings version this snapshot is built from.
+        """
+        self.__version = version
+        self.__data = {k: self.__freeze(v) for k, v in data.items()}
+
+    def __freeze(self, value):
+        if isinstance(value, dict):
+            return SettingsSnapshot(value, self.__version)
+        if isinstance(value, (list, tuple)):
+            return tuple([self.__freeze(i) for i in value])
+        return value
+
+    def __thaw(self, value):
+        if isinstance(value, SettingsSnapshot):
+            return value.to_dict()
+        if isinstance(value, tuple):
+            return [self.__thaw(i) for i in value]
+        return value
+
+    def __getattr__(self, key):
+        try:
+            return self.__data[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __getitem__(self, key):
+        return self.__data[key]
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def __iter__(self):
+        return iter(self.__data)
+
+    def __len__(self):
+        return len(self.__data)
+
+    @property
+    def version(self):
+        return self.__version
+
+    def get(self, key, default=None):
+        return self.__data.get(key, default)
+
+    def keys(self):
+        return self.__data.keys()
+
+    def values(self):
+        return self.__data.values()
+
+    def items(self):
+        return self.__data.items()
+
+    def to_dict(self):
+        """Get a mutable deep copy of this snapshot.
+
+        Returns:
+            dict
+        """
+        return {k: self.__thaw(v) for k, v in self.__data.items()}
+
+
 class Settings:
 
     def __init__(self, config_file="/usr/tracker_config.json"):
         self.__file = config_file
         self.__lock = _thread.allocate_lock()
         self.__data = {}
+        self.__version = 0
+        self.__snapshot = None
         self.__init_config()
+        self.__snapshot = SettingsSnapshot(self.__data, self.__version)
 
     def __init_config(self):
         try:
-            if not ql_fs.path_exists(self.__file):
+            data = atomic_read_json(self.__file)
+            if isinstance(data, dict):
+                self.__data = data
+            else:
                 # UserConfig init
                 self.__data["user"] = {k: v for k, v in UserConfig.__dict__.items() if not k.startswith("_")}
                 self.__data["user"]["ota_status"]["sys_current_version"] = FIRMWARE_VERSION
@@ -85,23 +165,46 @@ class Settings:
 
                 # LocConfig init
                 self.__data["loc"] = {k: v for k, v in LocConfig.__dict__.items() if not k.startswith("_")}
-                ql_fs.touch(self.__file, self.__data)
-            else:
-                self.__data = ql_fs.read_json(self.__file)
+                atomic_touch(self.__file, self.__data)
         except Exception as e:
             sys.print_exception(e)
 
+    def snapshot(self):
+        """Get the current read-only settings snapshot.
+
+        The snapshot is only rebuilt by `save`, so getting it is lock free and
+        callers should take one snapshot per cycle instead of reading per key.
+
+        Returns:
+            SettingsSnapshot
+        """
+        return self.__snapshot
+
     def read(self, key=None):
+        """Get a mutable copy of settings, changes take effect only by `save`.
+
+        Args:
+            key(str): settings group name, all settings if None.
+
+        Returns:
+            dict or None
+        """
         with self.__lock:
             try:
-                return self.__data if key is None else self.__data.get(key)
+                data = self.__data if key is None else self.__data.get(key)
+                return ujson.loads(ujson.dumps(data))
             except Exception as e:
                 sys.print_exception(e)
 
     def save(self, data):
         with self.__lock:
             res = -1
+            if isinstance(data, SettingsSnapshot):
+                data = data.to_dict()
             if isinstance(data, dict):
+                data = {k: v.to_dict() if isinstance(v, SettingsSnapshot) else v for k, v in data.items()}
                 self.__data.update(data)
-                res = ql_fs.touch(self.__file, self.__data)
+                res = atomic_touch(self.__file, self.__data)
+                self.__version += 1
+                self.__snapshot = SettingsSnapshot(self.__data, self.__version)
             return True if res == 0 else False
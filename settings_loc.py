@@ -75,6 +75,17 @@ class LocConfig:
         "BackupPin": None,
     }
 
+    # GNSS read ends when the fix meets this policy, `nmea` is the required sentences bitmask
+    # (RMC, GGA, GSV, GSA, VTG, GLL from bit 0), None for `gps_cfg["nmea"]`,
+    # `max_hdop` / `min_sats` are checked on GGA.
+    # e.g. first valid RMC: {"name": "first_rmc", "nmea": 0b000001, "max_hdop": None, "min_sats": None}
+    gps_fix_policy = {
+        "name": "nmea",
+        "nmea": None,
+        "max_hdop": None,
+        "min_sats": None,
+    }
+
     cell_cfg = {
         "serverAddr": "www.queclocator.com",
         "port": 80,
@@ -115,6 +115,18 @@ class UserConfig:
 
     loc_gps_read_timeout = 300
 
+    # Seconds to wait GNSS fix before a cell / wifi fix is accepted.
+    loc_network_wait = 30
+
+    # History data count of one report page, committed after the page is reported.
+    history_page_size = 10
+
+    # History unread data max size (byte), low priority data are downsampled and dropped over it.
+    history_max_bytes = 0x10000
+
+    # Reported history kept for time range query until the history file is over this size (byte).
+    history_retain_bytes = 0x8000
+
     work_mode = _work_mode.cycle
 
     work_mode_timeline = 3600
@@ -45,13 +45,14 @@ from machine import RTC, I2C
 from usr.settings_user import UserConfig
 from usr.settings import Settings, PROJECT_NAME, PROJECT_VERSION, FIRMWARE_NAME, FIRMWARE_VERSION
 from usr.modules.battery import Battery
-from usr.modules.history import History
-from usr.modules.logging import getLogger
+from usr.modules.history import History, HistoryRing, HistoryCache, TrackCodec
+from usr.modules.common import ThreadPool
+from usr.modules.logging import getLogger, getLogDiagnostics
 from usr.modules.net_manage import NetManage
 from usr.modules.aliyunIot import AliIot, AliIotOTA
 from usr.modules.power_manage import PowerManage, PMLock
 from usr.modules.temp_humidity_sensor import TempHumiditySensor
-from usr.modules.location import GNSS, CellLocator, WiFiLocator, NMEAParse, CoordinateSystemConvert
+from usr.modules.location import GNSS, CellLocator, WiFiLocator, NMEAParse, CoordinateSystemConvert, LocationRace, CellLocCache, CellTowerDB, WiFiFingerprintCache
 
 log = getLogger(__name__)
 
@@ -63,10 +64,7 @@ class Tracker:
         self.__server_ota = None
         self.__battery = None
         self.__history = None
-        self.__gnss = None
-        self.__cell = None
-        self.__wifi = None
-        self.__nmea_parse = None
+        self.__location = None
         self.__csc = None
         self.__net_manage = None
         self.__pm = None
@@ -114,11 +112,13 @@ class Tracker:
                 self.__business_tag = 0
 
     def __loc_report(self):
-        his_data = {"properties": {}, "events": []}
-        properties = self.__get_device_infos()
-        alarms = self.__get_alarms(properties)
+        cfg = self.__settings.snapshot()
+        properties = self.__get_device_infos(cfg)
+        alarms = self.__get_alarms(properties, cfg)
+        # Capture time is taken after the location read, which may last up to the GNSS timeout.
+        his_data = {"time": utime.mktime(utime.localtime()) * 1000, "properties": {}, "events": []}
         if self.__net_connect():
-            self.__history_report()
+            self.__history_report(cfg)
             res = self.__server.properties_report(properties)
             if not res:
                 his_data["properties"] = properties
@@ -129,27 +129,54 @@ class Tracker:
         if his_data["properties"] or his_data["events"]:
             self.__history.write([his_data])
 
-    def __history_report(self):
-        failed_datas = []
-        his_datas = self.__history.read()
-        if his_datas["data"]:
-            for item in his_datas["data"]:
-                faile_data = {"properties": {}, "events": []}
-                res = self.__server.properties_report(item["properties"])
-                if not res:
-                    faile_data["properties"] = item["properties"]
-                for alarm in item["events"]:
-                    res = self.__server.event_report(alarm, {})
-                    if not res:
-                        faile_data["events"].append(alarm)
-                if faile_data["properties"] or faile_data["events"]:
-                    failed_datas.append(faile_data)
-        if failed_datas:
-            self.__history.write(failed_datas)
-
-    def __get_device_infos(self):
-        user_cfg = self.__settings.read("user")
-        loc_cfg = self.__settings.read("loc")
+    def __history_report(self, cfg):
+        """Report history page by page in batch messages, a page is committed after acked.
+
+        Broken items are committed without sending. If a batch is rejected by reply code,
+        its first sample is sent alone and dropped when rejected again, so one bad sample
+        can not block the history behind it. Nothing is dropped when no reply is received.
+        """
+        user_cfg = cfg.user
+        page_size = user_cfg.get("history_page_size", UserConfig.history_page_size)
+        while True:
+            his_datas = self.__history.peek(page_size)
+            if not his_datas:
+                break
+            samples = [(item.get("time"), item["properties"], item["events"]) for item in his_datas if item]
+            sent = self.__server.batch_report(samples) if samples else 0
+            if sent < 0:
+                sent = self.__history_report_single(samples[0], len(samples) > 1)
+            # Broken items are not in samples, commit them with the sent items around them.
+            count = 0
+            for item in his_datas:
+                if item:
+                    if not sent:
+                        break
+                    sent -= 1
+                count += 1
+            self.__history.commit(count)
+            if not count:
+                break
+
+    def __history_report_single(self, sample, retry=True):
+        """Report one sample of a rejected batch.
+
+        Args:
+            sample (tuple): (time, properties, events)
+            retry (bool): send the sample again, False if it was sent alone already.
+
+        Returns:
+            int: 1 - sample is sent or dropped, 0 - no reply, keep it.
+        """
+        res = self.__server.batch_report([sample]) if retry else -1
+        if res < 0:
+            log.warn("History sample %s is rejected, drop it." % str(sample))
+            return 1
+        return res
+
+    def __get_device_infos(self, cfg):
+        user_cfg = cfg.user
+        loc_cfg = cfg.loc
         properties = {
             "power_switch": 1,
             "energy": self.__battery.energy,
@@ -178,7 +205,7 @@ class Tracker:
             "drive_behavior_code": user_cfg["drive_behavior_code"],
             "over_speed_threshold": user_cfg["over_speed_threshold"],
             "user_ota_action": user_cfg["user_ota_action"],
-            "ota_status": user_cfg["ota_status"],
+            "ota_status": user_cfg["ota_status"].to_dict(),
             "work_mode_timeline": user_cfg["work_mode_timeline"],
             "loc_gps_read_timeout": user_cfg["loc_gps_read_timeout"],
             "gps_mode": loc_cfg["gps_cfg"]["gps_mode"],
@@ -191,15 +218,14 @@ class Tracker:
                 # "mike": 0,
             },
         }
-        properties.update(self.__get_loc_data())
+        properties.update(self.__get_loc_data(cfg))
         properties["device_module_status"]["location"] = 1 if properties["GeoLocation"]["Longitude"] else 0
         properties.update(self.__get_temp_humitity())
         properties["device_module_status"]["temp_sensor"] = 1 if properties.get("temperature") is not None or properties.get("humidity") is not None else 0
         properties["device_module_status"]["net"] = int(self.__net_manage.status)
         return properties
 
-    def __get_loc_data(self):
-        loc_state = 0
+    def __get_loc_data(self, cfg):
         loc_data = {
             "GeoLocation": {
                 "Longitude": 0.0,
@@ -209,35 +235,27 @@ class Tracker:
             },
             "current_speed": -1,
         }
-        loc_cfg = self.__settings.read("loc")
+        loc_cfg = cfg.loc
         loc_data["GeoLocation"]["CoordinateSystem"] = 1 if loc_cfg["map_coordinate_system"] == "WGS84" else 2
-        user_cfg = self.__settings.read("user")
-        if user_cfg["loc_method"] & UserConfig._loc_method.gps:
-            res = self.__gnss.read(user_cfg["loc_gps_read_timeout"])
-            if res[0] == 0:
-                gnss_data = res[1]
-                self.__nmea_parse.set_gps_data(gnss_data)
-                loc_data["GeoLocation"]["Longitude"] = float(self.__nmea_parse.Longitude)
-                loc_data["GeoLocation"]["Latitude"] = float(self.__nmea_parse.Latitude)
-                loc_data["GeoLocation"]["Altitude"] = float(self.__nmea_parse.Altitude)
-                loc_data["current_speed"] = float(self.__nmea_parse.Speed)
-                loc_state = 1
-        if loc_state == 0 and user_cfg["loc_method"] & UserConfig._loc_method.cell:
-            res = self.__cell.read()
-            if res:
-                loc_data["GeoLocation"]["Longitude"] = res[0]
-                loc_data["GeoLocation"]["Latitude"] = res[1]
-                loc_state = 1
-        if loc_state == 0 and user_cfg["loc_method"] & UserConfig._loc_method.wifi:
-            res = self.__wifi.read()
-            if res:
-                loc_data["GeoLocation"]["Longitude"] = res[0]
-                loc_data["GeoLocation"]["Latitude"] = res[1]
-                loc_state = 1
-        if loc_state == 1 and loc_cfg["map_coordinate_system"] == "GCJ02":
-            lng, lat = self.__csc.wgs84_to_gcj02(loc_data["GeoLocation"]["Longitude"], loc_data["GeoLocation"]["Latitude"])
-            loc_data["GeoLocation"]["Longitude"] = lng
-            loc_data["GeoLocation"]["Latitude"] = lat
+        user_cfg = cfg.user
+        fix = self.__location.read(
+            gps=bool(user_cfg["loc_method"] & UserConfig._loc_method.gps),
+            cell=bool(user_cfg["loc_method"] & UserConfig._loc_method.cell),
+            wifi=bool(user_cfg["loc_method"] & UserConfig._loc_method.wifi),
+            gps_timeout=user_cfg["loc_gps_read_timeout"],
+            network_wait=user_cfg.get("loc_network_wait", UserConfig.loc_network_wait),
+        )
+        if fix is not None:
+            if loc_cfg["map_coordinate_system"] == "GCJ02":
+                fix.lon, fix.lat = self.__csc.wgs84_to_gcj02(fix.lon, fix.lat)
+            loc_data["GeoLocation"]["Longitude"] = fix.lon
+            loc_data["GeoLocation"]["Latitude"] = fix.lat
+            if fix.alt is not None:
+                loc_data["GeoLocation"]["Altitude"] = fix.alt
+            if fix.speed is not None:
+                loc_data["current_speed"] = fix.speed
+            # Not reported as properties, they are not in the product TSL model.
+            log.debug("Fix source: %s, policy: %s." % (fix.source, fix.policy))
         return loc_data
 
     def __get_temp_humitity(self):
@@ -249,9 +267,9 @@ class Tracker:
             data["humidity"] = res[1]
         return data
 
-    def __get_alarms(self, properties):
+    def __get_alarms(self, properties, cfg):
         alarms = []
-        user_cfg = self.__settings.read("user")
+        user_cfg = cfg.user
         if user_cfg["sw_over_speed_alert"] and properties["current_speed"] >= user_cfg["over_speed_threshold"]:
             alarms.append("over_speed_alert")
         if user_cfg["sw_sim_abnormal_alert"] and self.__net_manage.sim_status != 1:
@@ -300,10 +318,13 @@ class Tracker:
             if self.__business_queue.size() == 0 and self.__business_tag == 0:
                 break
             utime.sleep_ms(500)
-        user_cfg = self.__settings.read("user")
+        user_cfg = self.__settings.snapshot().user
         if user_cfg["work_cycle_period"] < user_cfg["work_mode_timeline"]:
             self.__pm.autosleep(1)
         else:
+            # RAM is kept in autosleep, the cache is only written out before PSM.
+            if isinstance(self.__history, HistoryCache):
+                self.__history.flush()
             self.__pm.set_psm(mode=1, tau=user_cfg["work_cycle_period"], act=5)
         self.__set_rtc(user_cfg["work_cycle_period"], self.running)
 
@@ -345,7 +366,7 @@ class Tracker:
             service = topic.split("/")[-1]
             self.__server_service_response(service, data)
         elif topic.startswith("/ota/device/upgrade/") or topic.endswith("/ota/firmware/get_reply"):
-            user_cfg = self.__settings.read("user")
+            user_cfg = self.__settings.snapshot().user
             if self.__server_ota_flag == 0:
                 if user_cfg["sw_ota"] == 1:
                     self.__server_ota_flag = 1
@@ -413,14 +434,49 @@ class Tracker:
             log.debug("ota_firmware_get firmware %s" % res)
 
     def __server_rrpc_response(self, msg_id, data):
+        if isinstance(data, dict) and data.get("method") == "history_query":
+            data = self.__history_query(data.get("params", {}))
+        elif isinstance(data, dict) and data.get("method") == "diagnostics":
+            data = self.__diagnostics()
         self.__server.rrpc_response(msg_id, data)
 
+    def __diagnostics(self):
+        """Storage diagnostics for RRPC `diagnostics`, history and log segments write counts."""
+        history = self.__history.diagnostics() if hasattr(self.__history, "diagnostics") else {}
+        return {"code": 200, "history": history, "log": getLogDiagnostics()}
+
+    def __history_query(self, params):
+        """Query history in a time range for RRPC `history_query`.
+
+        Args:
+            params (dict): {"start": seconds, "end": seconds, "num": page size, "next": token of next page}
+
+        Returns:
+            dict: {"code": 200, "data": [xxx], "next": token or None}
+        """
+        history = self.__history.history if isinstance(self.__history, HistoryCache) else self.__history
+        if not hasattr(history, "query"):
+            return {"code": 404, "message": "history query is not supported"}
+        try:
+            res = self.__history.query(
+                int(params["start"]),
+                int(params["end"]),
+                min(int(params.get("num", 10)), 50),
+                params.get("next")
+            )
+            return {"code": 200, "data": res["data"], "next": res["next"]}
+        except Exception as e:
+            sys.print_exception(e)
+            return {"code": 400, "message": "params error"}
+
     def __server_service_response(self, service, data):
         msg_id = data.get("id")
         self.__server.service_response(service, 200, {}, msg_id, "success")
 
     def __power_restart(self):
         log.debug("__power_restart")
+        if isinstance(self.__history, HistoryCache):
+            self.__history.flush()
         Power.powerRestart()
 
     def __ota_cfg_refresh(self):
@@ -442,16 +498,10 @@ class Tracker:
             self.__server_ota = module
         elif isinstance(module, Battery):
             self.__battery = module
-        elif isinstance(module, History):
+        elif isinstance(module, (History, HistoryRing, HistoryCache)):
             self.__history = module
-        elif isinstance(module, GNSS):
-            self.__gnss = module
-        elif isinstance(module, CellLocator):
-            self.__cell = module
-        elif isinstance(module, WiFiLocator):
-            self.__wifi = module
-        elif isinstance(module, NMEAParse):
-            self.__nmea_parse = module
+        elif isinstance(module, LocationRace):
+            self.__location = module
         elif isinstance(module, CoordinateSystemConvert):
             self.__csc = module
         elif isinstance(module, NetManage):
@@ -491,12 +541,39 @@ class Tracker:
             self.__server.disconnect()
 
 
+def history_priority(item):
+    """History eviction priority, alarms are kept over fixes over routine properties."""
+    if item.get("events"):
+        return History.PRIO_EVENT
+    if item["properties"].get("GeoLocation", {}).get("Longitude"):
+        return History.PRIO_FIX
+    return History.PRIO_STATIC
+
+
+def history_timestamp(item):
+    return item["time"] // 1000 if item.get("time") else None
+
+
 def main():
     # Initialize base modules.
     net_manage = NetManage(PROJECT_NAME, PROJECT_VERSION)
     settings = Settings()
     battery = Battery()
-    history = History()
+    history = History(
+        max_hist_num=None,
+        max_bytes=settings.read("user").get("history_max_bytes", UserConfig.history_max_bytes),
+        priority=history_priority,
+        timestamp=history_timestamp,
+        retain_bytes=settings.read("user").get("history_retain_bytes", UserConfig.history_retain_bytes),
+        codec=TrackCodec(fields=(
+            (("time",), 1000, "i"),
+            (("properties", "GeoLocation", "Longitude"), 10000000, "f"),
+            (("properties", "GeoLocation", "Latitude"), 10000000, "f"),
+            (("properties", "GeoLocation", "Altitude"), 100, "f"),
+            (("properties", "current_speed"), 100, "f"),
+        ))
+    )
+    history_cache = HistoryCache(history)
     server_cfg = settings.read("server")
     server = AliIot(**server_cfg)
     server_ota = AliIotOTA(PROJECT_NAME, FIRMWARE_NAME)
@@ -504,26 +581,26 @@ def main():
     power_manage = PowerManage()
     temp_sensor = TempHumiditySensor(i2cn=I2C.I2C1, mode=I2C.FAST_MODE)
     loc_cfg = settings.read("loc")
-    gnss = GNSS(**loc_cfg["gps_cfg"])
-    cell = CellLocator(**loc_cfg["cell_cfg"])
-    wifi = WiFiLocator(**loc_cfg["wifi_cfg"])
+    gnss = GNSS(gps_sleep_mode=loc_cfg["gps_sleep_mode"], fix_policy=loc_cfg.get("gps_fix_policy"), **loc_cfg["gps_cfg"])
+    # A read running past its timeout keeps its worker, two workers for each of cell and wifi reads.
+    loc_pool = ThreadPool(4)
+    cell = CellLocator(cache=CellLocCache(), db=CellTowerDB(), pool=loc_pool, **loc_cfg["cell_cfg"])
+    wifi = WiFiLocator(cache=WiFiFingerprintCache(), pool=loc_pool, **loc_cfg["wifi_cfg"])
     nmea_parse = NMEAParse()
+    location = LocationRace(gnss, cell, wifi, nmea_parse)
     cyc = CoordinateSystemConvert()
 
     # Initialize tracker business modules.
     tracker = Tracker()
     tracker.add_module(settings)
     tracker.add_module(battery)
-    tracker.add_module(history)
+    tracker.add_module(history_cache)
     tracker.add_module(net_manage)
     tracker.add_module(server)
     tracker.add_module(server_ota)
     tracker.add_module(power_manage)
     tracker.add_module(temp_sensor)
-    tracker.add_module(gnss)
-    tracker.add_module(cell)
-    tracker.add_module(wifi)
-    tracker.add_module(nmea_parse)
+    tracker.add_module(location)
     tracker.add_module(cyc)
 
     # Set net and server callback.
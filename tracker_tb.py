@@ -35,6 +35,7 @@
 @copyright :Copyright (c) 2022
 """
 
+import ujson
 import utime
 import _thread
 import usys as sys
@@ -45,13 +46,14 @@ from machine import RTC, I2C
 from usr.settings_user import UserConfig
 from usr.settings import Settings, PROJECT_NAME, PROJECT_VERSION
 from usr.modules.battery import Battery
-from usr.modules.history import History
-from usr.modules.logging import getLogger
+from usr.modules.history import History, HistoryRing, HistoryCache, TrackCodec
+from usr.modules.common import ThreadPool
+from usr.modules.logging import getLogger, getLogDiagnostics
 from usr.modules.net_manage import NetManage
-from usr.modules.thingsboard import TBDeviceMQTTClient
+from usr.modules.thingsboard import TBDeviceMQTTClient, RPC_REQUEST_TOPIC
 from usr.modules.power_manage import PowerManage, PMLock
 from usr.modules.temp_humidity_sensor import TempHumiditySensor
-from usr.modules.location import GNSS, CellLocator, WiFiLocator, NMEAParse, CoordinateSystemConvert
+from usr.modules.location import GNSS, CellLocator, WiFiLocator, NMEAParse, CoordinateSystemConvert, LocationRace, CellLocCache, CellTowerDB, WiFiFingerprintCache
 
 log = getLogger(__name__)
 
@@ -63,10 +65,7 @@ class Tracker:
         self.__server_ota = None
         self.__battery = None
         self.__history = None
-        self.__gnss = None
-        self.__cell = None
-        self.__wifi = None
-        self.__nmea_parse = None
+        self.__location = None
         self.__csc = None
         self.__net_manage = None
         self.__pm = None
@@ -110,64 +109,72 @@ class Tracker:
                 self.__business_tag = 0
 
     def __loc_report(self):
-        properties = self.__get_device_infos()
+        cfg = self.__settings.snapshot()
+        values = self.__get_device_infos(cfg)
+        # Capture time is taken after the location read, which may last up to the GNSS timeout.
+        telemetry = {"ts": utime.mktime(utime.localtime()) * 1000, "values": values}
         if self.__net_connect():
-            self.__history_report()
-            res = self.__server.send_telemetry(properties)
+            self.__history_report(cfg)
+            res = self.__server.send_telemetry(telemetry)
             if not res:
-                self.__history.write([properties])
-
-    def __history_report(self):
-        failed_datas = []
-        his_datas = self.__history.read()
-        if his_datas["data"]:
-            for item in his_datas["data"]:
-                res = self.__server.send_telemetry(item)
-                if not res:
-                    failed_datas.append(item)
-        if failed_datas:
-            self.__history.write(failed_datas)
-
-    def __get_device_infos(self):
-        properties = self.__get_loc_data()
+                self.__history.write([telemetry])
+
+    def __history_report(self, cfg):
+        """Report history page by page in batch telemetry, a page is committed after sent."""
+        user_cfg = cfg.user
+        page_size = user_cfg.get("history_page_size", UserConfig.history_page_size)
+        while True:
+            his_datas = self.__history.peek(page_size)
+            if not his_datas:
+                break
+            # Items saved before timestamped are reported with current time.
+            now = utime.mktime(utime.localtime()) * 1000
+            samples = [item if "values" in item else {"ts": now, "values": item} for item in his_datas if item]
+            sent = self.__server.send_telemetry_batch(samples)
+            # Broken items are not in samples, commit them with the sent items around them.
+            count = 0
+            for item in his_datas:
+                if item:
+                    if not sent:
+                        break
+                    sent -= 1
+                count += 1
+            self.__history.commit(count)
+            if count < len(his_datas):
+                break
+
+    def __get_device_infos(self, cfg):
+        properties = self.__get_loc_data(cfg)
         return properties
 
-    def __get_loc_data(self):
-        loc_state = 0
+    def __get_loc_data(self, cfg):
         loc_data = {
             "Longitude": 181,
             "Latitude": 91,
             "Altitude": -1,
             "Speed": -1,
         }
-        loc_cfg = self.__settings.read("loc")
-        user_cfg = self.__settings.read("user")
-        if user_cfg["loc_method"] & UserConfig._loc_method.gps:
-            res = self.__gnss.read(user_cfg["loc_gps_read_timeout"])
-            if res[0] == 0:
-                gnss_data = res[1]
-                self.__nmea_parse.set_gps_data(gnss_data)
-                loc_data["Longitude"] = float(self.__nmea_parse.Longitude)
-                loc_data["Latitude"] = float(self.__nmea_parse.Latitude)
-                loc_data["Altitude"] = float(self.__nmea_parse.Altitude)
-                loc_data["current_speed"] = float(self.__nmea_parse.Speed)
-                loc_state = 1
-        if loc_state == 0 and user_cfg["loc_method"] & UserConfig._loc_method.cell:
-            res = self.__cell.read()
-            if res:
-                loc_data["Longitude"] = res[0]
-                loc_data["Latitude"] = res[1]
-                loc_state = 1
-        if loc_state == 0 and user_cfg["loc_method"] & UserConfig._loc_method.wifi:
-            res = self.__wifi.read()
-            if res:
-                loc_data["Longitude"] = res[0]
-                loc_data["Latitude"] = res[1]
-                loc_state = 1
-        if loc_state == 1 and loc_cfg["map_coordinate_system"] == "GCJ02":
-            lng, lat = self.__csc.wgs84_to_gcj02(loc_data["Longitude"], loc_data["Latitude"])
-            loc_data["Longitude"] = lng
-            loc_data["Latitude"] = lat
+        loc_cfg = cfg.loc
+        user_cfg = cfg.user
+        fix = self.__location.read(
+            gps=bool(user_cfg["loc_method"] & UserConfig._loc_method.gps),
+            cell=bool(user_cfg["loc_method"] & UserConfig._loc_method.cell),
+            wifi=bool(user_cfg["loc_method"] & UserConfig._loc_method.wifi),
+            gps_timeout=user_cfg["loc_gps_read_timeout"],
+            network_wait=user_cfg.get("loc_network_wait", UserConfig.loc_network_wait),
+        )
+        if fix is not None:
+            if loc_cfg["map_coordinate_system"] == "GCJ02":
+                fix.lon, fix.lat = self.__csc.wgs84_to_gcj02(fix.lon, fix.lat)
+            loc_data["Longitude"] = fix.lon
+            loc_data["Latitude"] = fix.lat
+            if fix.alt is not None:
+                loc_data["Altitude"] = fix.alt
+            if fix.speed is not None:
+                loc_data["current_speed"] = fix.speed
+            loc_data["loc_source"] = fix.source
+            if fix.policy:
+                loc_data["loc_policy"] = fix.policy
         return loc_data
 
     def __net_connect(self, retry=2):
@@ -207,10 +214,13 @@ class Tracker:
             if self.__business_queue.size() == 0 and self.__business_tag == 0:
                 break
             utime.sleep_ms(500)
-        user_cfg = self.__settings.read("user")
+        user_cfg = self.__settings.snapshot().user
         if user_cfg["work_cycle_period"] < user_cfg["work_mode_timeline"]:
             self.__pm.autosleep(1)
         else:
+            # RAM is kept in autosleep, the cache is only written out before PSM.
+            if isinstance(self.__history, HistoryCache):
+                self.__history.flush()
             self.__pm.set_psm(mode=1, tau=user_cfg["work_cycle_period"], act=5)
         self.__set_rtc(user_cfg["work_cycle_period"], self.running)
 
@@ -225,11 +235,52 @@ class Tracker:
         return self.__business_rtc.enable_alarm(1) if _res == 0 else -1
 
     def __server_option(self, topic, data):
-        # TODO:
-        pass
+        topic = topic.decode() if isinstance(topic, bytes) else topic
+        if topic.startswith(RPC_REQUEST_TOPIC):
+            request_id = topic.split("/")[-1]
+            try:
+                data = ujson.loads(data)
+            except Exception as e:
+                sys.print_exception(e)
+                return
+            if data.get("method") == "history_query":
+                self.__server.send_rpc_reply(self.__history_query(data.get("params", {})), request_id)
+            elif data.get("method") == "diagnostics":
+                self.__server.send_rpc_reply(self.__diagnostics(), request_id)
+
+    def __diagnostics(self):
+        """Storage diagnostics for RPC `diagnostics`, history and log segments write counts."""
+        history = self.__history.diagnostics() if hasattr(self.__history, "diagnostics") else {}
+        return {"code": 200, "history": history, "log": getLogDiagnostics()}
+
+    def __history_query(self, params):
+        """Query history in a time range for RPC `history_query`.
+
+        Args:
+            params (dict): {"start": seconds, "end": seconds, "num": page size, "next": token of next page}
+
+        Returns:
+            dict: {"code": 200, "data": [xxx], "next": token or None}
+        """
+        history = self.__history.history if isinstance(self.__history, HistoryCache) else self.__history
+        if not hasattr(history, "query"):
+            return {"code": 404, "message": "history query is not supported"}
+        try:
+            res = self.__history.query(
+                int(params["start"]),
+                int(params["end"]),
+                min(int(params.get("num", 10)), 50),
+                params.get("next")
+            )
+            return {"code": 200, "data": res["data"], "next": res["next"]}
+        except Exception as e:
+            sys.print_exception(e)
+            return {"code": 400, "message": "params error"}
 
     def __power_restart(self):
         log.debug("__power_restart")
+        if isinstance(self.__history, HistoryCache):
+            self.__history.flush()
         Power.powerRestart()
 
     def add_module(self, module):
@@ -237,16 +288,10 @@ class Tracker:
             self.__server = module
         elif isinstance(module, Battery):
             self.__battery = module
-        elif isinstance(module, History):
+        elif isinstance(module, (History, HistoryRing, HistoryCache)):
             self.__history = module
-        elif isinstance(module, GNSS):
-            self.__gnss = module
-        elif isinstance(module, CellLocator):
-            self.__cell = module
-        elif isinstance(module, WiFiLocator):
-            self.__wifi = module
-        elif isinstance(module, NMEAParse):
-            self.__nmea_parse = module
+        elif isinstance(module, LocationRace):
+            self.__location = module
         elif isinstance(module, CoordinateSystemConvert):
             self.__csc = module
         elif isinstance(module, NetManage):
@@ -275,8 +320,8 @@ class Tracker:
         self.__business_queue.put((0, "into_sleep"))
         self.__running_tag = 0
 
-    def server_callback(self, args):
-        self.__business_queue.put((1, args))
+    def server_callback(self, topic, msg):
+        self.__business_queue.put((1, (topic, msg)))
 
     def net_callback(self, args):
         log.debug("net_callback args: %s" % str(args))
@@ -284,34 +329,61 @@ class Tracker:
             self.__server.disconnect()
 
 
+def history_priority(item):
+    """History eviction priority, fixes are kept over routine telemetry."""
+    values = item.get("values", item)
+    # Longitude is 181 without a fix.
+    if values.get("Longitude") not in (None, 181):
+        return History.PRIO_FIX
+    return History.PRIO_STATIC
+
+
+def history_timestamp(item):
+    return item["ts"] // 1000 if item.get("ts") else None
+
+
 def main():
     net_manage = NetManage(PROJECT_NAME, PROJECT_VERSION)
     settings = Settings()
     battery = Battery()
-    history = History()
+    history = History(
+        max_hist_num=None,
+        max_bytes=settings.read("user").get("history_max_bytes", UserConfig.history_max_bytes),
+        priority=history_priority,
+        timestamp=history_timestamp,
+        retain_bytes=settings.read("user").get("history_retain_bytes", UserConfig.history_retain_bytes),
+        codec=TrackCodec(fields=(
+            (("ts",), 1000, "i"),
+            (("values", "Longitude"), 10000000, "f"),
+            (("values", "Latitude"), 10000000, "f"),
+            (("values", "Altitude"), 100, "f"),
+            (("values", "current_speed"), 100, "f"),
+        ))
+    )
+    history_cache = HistoryCache(history)
     server_cfg = settings.read("server")
     server = TBDeviceMQTTClient(**server_cfg)
     power_manage = PowerManage()
     temp_sensor = TempHumiditySensor(i2cn=I2C.I2C1, mode=I2C.FAST_MODE)
     loc_cfg = settings.read("loc")
-    gnss = GNSS(**loc_cfg["gps_cfg"])
-    cell = CellLocator(**loc_cfg["cell_cfg"])
-    wifi = WiFiLocator(**loc_cfg["wifi_cfg"])
+    gnss = GNSS(gps_sleep_mode=loc_cfg["gps_sleep_mode"], fix_policy=loc_cfg.get("gps_fix_policy"), **loc_cfg["gps_cfg"])
+    # A read running past its timeout keeps its worker, two workers for each of cell and wifi reads.
+    loc_pool = ThreadPool(4)
+    cell = CellLocator(cache=CellLocCache(), db=CellTowerDB(), pool=loc_pool, **loc_cfg["cell_cfg"])
+    wifi = WiFiLocator(cache=WiFiFingerprintCache(), pool=loc_pool, **loc_cfg["wifi_cfg"])
     nmea_parse = NMEAParse()
+    location = LocationRace(gnss, cell, wifi, nmea_parse)
     cyc = CoordinateSystemConvert()
 
     tracker = Tracker()
     tracker.add_module(settings)
     tracker.add_module(battery)
-    tracker.add_module(history)
+    tracker.add_module(history_cache)
     tracker.add_module(net_manage)
     tracker.add_module(server)
     tracker.add_module(power_manage)
     tracker.add_module(temp_sensor)
-    tracker.add_module(gnss)
-    tracker.add_module(cell)
-    tracker.add_module(wifi)
-    tracker.add_module(nmea_parse)
+    tracker.add_module(location)
     tracker.add_module(cyc)
 
     net_manage.set_callback(tracker.net_callback)